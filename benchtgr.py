@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for tgrlib and tgrtool, run on a synthetic corpus.
+
+The corpus is generated from a fixed seed, so runs can be compared.
+Each corpus file has a set frame count, frame size, bit depth and mix
+of run kinds. The files are packed with encode_frame and TgrWriter,
+as pack does, and their source frames are kept for the pack benchmark.
+
+Timings are the best of --repeat runs. Rates are given in pixels of the
+source frames and MB of the packed .TGR. Peak memory is measured in a
+separate run with tracemalloc, so it doesn't slow the timed runs.
+Results are saved as JSON, and can be checked against a saved baseline:
+
+    python benchtgr.py -o baseline.json
+    python benchtgr.py --baseline baseline.json --threshold 0.15
+"""
+
+import argparse
+import contextlib
+import json
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import tgrlib
+import tgrtool
+from pathlib import Path
+from PIL import Image
+
+# Relative weights of the kinds of run in each mix
+mixes = {
+    'opaque': {'repeat': 3, 'noise': 6, 'transparent': 1},
+    'translucent': {'translucent': 6, 'repeat': 1, 'transparent': 2, 'shadow': 1},
+    'player': {'player': 6, 'repeat': 1, 'noise': 1, 'transparent': 2},
+    'mixed': {'transparent': 3, 'shadow': 1, 'repeat': 2, 'noise': 2, 'translucent': 1, 'player': 1},
+    'sparse': {'transparent': 12, 'repeat': 1, 'noise': 1},
+}
+
+# name: (frame count, width, height, bits per pixel, mix)
+default_corpus = {
+    'units-16': (32, 96, 96, 16, 'mixed'),
+    'units-8': (32, 96, 96, 8, 'mixed'),
+    'effects-16': (16, 160, 160, 16, 'translucent'),
+    'player-16': (16, 128, 128, 16, 'player'),
+    'large-16': (4, 512, 512, 16, 'opaque'),
+    'sparse-16': (16, 256, 256, 16, 'sparse'),
+}
+quick_corpus = {
+    'units-16': (8, 64, 64, 16, 'mixed'),
+    'units-8': (8, 64, 64, 8, 'mixed'),
+}
+
+sprite_ini = """[BitDepth]
+Depth = {depth}
+[HotSpot]
+X = 0
+Y = 0
+[BoundingBox]
+XMin = 0
+YMin = 0
+XMax = 0
+YMax = 0
+[PaddingFrames]
+FrameList =
+[Animation0]
+StartFrame = 0
+FrameCount = {frames}
+AnimationCount = 1
+"""
+
+color = 2
+
+def synthetic_frame(rng: np.random.Generator, width: int, height: int, mix: str) -> np.ndarray:
+    """An RGBA frame of runs of 1 to 40 pixels, of kinds picked with the
+    weights of the mix"""
+    kinds = list(mixes[mix])
+    weights = np.array([mixes[mix][k] for k in kinds], dtype=float)
+    weights /= weights.sum()
+    shades = np.array([tuple(p.values()) for (shade, p) in tgrlib.player_cols[color].items() if shade < 32], dtype=np.uint8)
+    frame = np.zeros((height, width, 4), dtype=np.uint8)
+    for row in frame:
+        x = 0
+        while x < width:
+            length = min(int(rng.integers(1, 41)), width - x)
+            segment = row[x:x + length]
+            kind = kinds[rng.choice(len(kinds), p=weights)]
+            if kind == 'shadow':
+                segment[:] = tuple(tgrlib.shadow.values())
+            elif kind == 'repeat':
+                segment[:] = [*rng.integers(0, 256, 3), 255]
+            elif kind == 'noise':
+                segment[:, :3] = rng.integers(0, 256, (length, 3))
+                segment[:, 3] = 255
+            elif kind == 'translucent':
+                segment[:] = [*rng.integers(0, 256, 3), rng.integers(1, 255)]
+            elif kind == 'player':
+                segment[:] = shades[rng.integers(0, len(shades), length)]
+            x += length
+    # A visible corner keeps every frame the full size when cropped
+    frame[0, 0] = frame[-1, -1] = (255, 255, 255, 255)
+    return frame
+
+def make_corpus(corpus_dir: Path, corpus: dict, seed=0) -> dict:
+    """Write the source frames and packed .TGR of each corpus entry,
+    returning the paths and sizes of each"""
+    rng = np.random.default_rng(seed)
+    files = {}
+    for (name, (frame_count, width, height, depth, mix)) in corpus.items():
+        source = corpus_dir / name
+        source.mkdir(parents=True, exist_ok=True)
+        for frame_index in range(frame_count):
+            Image.fromarray(synthetic_frame(rng, width, height, mix)).save(source / f'fram_{frame_index:04d}.png', compress_level=1)
+        (source / 'sprite.ini').write_text(sprite_ini.format(depth=depth, frames=frame_count))
+        tgr_path = corpus_dir / f'{name}.tgr'
+        imagefile = tgrlib.tgrFile(source, on_event=tgrlib.ignore_event)
+        imagefile.load(source / 'sprite.ini', lazy=True)
+        if depth == 8:
+            imagefile.pack_palette = tgrlib.median_cut_palette(imagefile.color_histogram(color))
+        with open(tgr_path, 'wb') as fh_out, tgrlib.TgrWriter(fh_out, imagefile) as writer:
+            for (frame_index, pixels) in imagefile.stream_frames():
+                writer.write_frame(tgrlib.encode_frame(pixels, color, frame_index, palette=imagefile.pack_palette))
+        files[name] = {'source': source, 'tgr': tgr_path, 'pixels': frame_count * width * height,
+                       'bytes': tgr_path.stat().st_size, 'depth': depth, 'mix': mix}
+    return files
+
+def load_tgr(tgr_path: Path) -> tgrlib.tgrFile:
+    imagefile = tgrlib.tgrFile(tgr_path, on_event=tgrlib.ignore_event)
+    imagefile.load()
+    return imagefile
+
+def bench_load(entry: dict, workdir: Path):
+    """Parse the IFF chunks, header and palette, and index every frame's lines"""
+    imagefile = load_tgr(entry['tgr'])
+    for frame in imagefile.frames:
+        frame.lines
+    imagefile.close()
+
+def bench_decode(entry: dict, workdir: Path):
+    imagefile = load_tgr(entry['tgr'])
+    for frame_index in range(len(imagefile.frames)):
+        imagefile.decodeFrame(frame_index, color)
+    imagefile.close()
+
+def source_frames(entry: dict):
+    """The cropped source frames of a corpus entry, read once and kept"""
+    if 'frames' not in entry:
+        imagefile = tgrlib.tgrFile(entry['source'], on_event=tgrlib.ignore_event)
+        imagefile.load(entry['source'] / 'sprite.ini')
+        palette = None
+        if entry['depth'] == 8:
+            palette = tgrlib.median_cut_palette(imagefile.color_histogram(color))
+        entry['frames'] = imagefile.img_data
+        entry['palette'] = palette
+        entry['runs'] = [tgrlib.scan_frame_runs(pixels, color, palette) for pixels in imagefile.img_data]
+    return (entry['frames'], entry['palette'], entry['runs'])
+
+def bench_encode_line(entry: dict, workdir: Path):
+    """encode_line alone, on runs found beforehand"""
+    (frames, _, runs) = source_frames(entry)
+    for (pixels, frame_runs) in zip(frames, runs):
+        (height, width) = pixels.shape[:2]
+        for line_index in range(height):
+            tgrlib.encode_line(frame_runs, line_index, width)
+
+def bench_encode_frame(entry: dict, workdir: Path):
+    (frames, palette, _) = source_frames(entry)
+    for (frame_index, pixels) in enumerate(frames):
+        tgrlib.encode_frame(pixels, color, frame_index, palette=palette)
+
+def run_tgrtool(*argv):
+    args = tgrtool.main_parse.parse_args([str(arg) for arg in argv])
+    tgrtool.run(args, on_event=tgrlib.ignore_event)
+
+def bench_pack(entry: dict, workdir: Path):
+    run_tgrtool('pack', '--no-cache', '-c', color, '-o', workdir / 'pack.tgr', entry['source'])
+
+def bench_unpack(entry: dict, workdir: Path):
+    output = workdir / 'unpack'
+    shutil.rmtree(output, ignore_errors=True)
+    run_tgrtool('unpack', '-c', color, '--compress-level', 1, '-o', output, entry['tgr'])
+
+# Setup run before timing a benchmark, so its timings don't include it
+setups = {
+    'encode_line': source_frames,
+    'encode_frame': source_frames,
+}
+
+benchmarks = {
+    'load': bench_load,
+    'decode': bench_decode,
+    'encode_line': bench_encode_line,
+    'encode_frame': bench_encode_frame,
+    'pack': bench_pack,
+    'unpack': bench_unpack,
+}
+
+def measure(bench, entry: dict, workdir: Path, repeat: int, memory: bool) -> dict:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        bench(entry, workdir)
+        seconds.append(time.perf_counter() - start)
+    best = min(seconds)
+    result = {'seconds': best,
+              'pixels_per_s': entry['pixels'] / best,
+              'mb_per_s': entry['bytes'] / best / 1e6}
+    if memory:
+        tracemalloc.start()
+        bench(entry, workdir)
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return result
+
+def compare(results: dict, baseline: dict, threshold: float, memory_threshold: float) -> list:
+    """Describe each benchmark that is slower, or uses more memory, than
+    its baseline by more than the thresholds"""
+    regressions = []
+    for (name, result) in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        change = result['seconds'] / base['seconds'] - 1
+        if change > threshold:
+            regressions.append(f'{name}: {result["seconds"]:.4f}s is {change:.0%} slower than {base["seconds"]:.4f}s')
+        if 'peak_mb' in result and 'peak_mb' in base and base['peak_mb'] > 0:
+            change = result['peak_mb'] / base['peak_mb'] - 1
+            if change > memory_threshold:
+                regressions.append(f'{name}: {result["peak_mb"]:.1f}MB peak is {change:.0%} more than {base["peak_mb"]:.1f}MB')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Time tgrlib and tgrtool on a synthetic corpus')
+    parser.add_argument('--quick', action='store_true', help='use a small corpus, for checking the benchmarks run')
+    parser.add_argument('--benchmarks', nargs='+', choices=list(benchmarks), default=list(benchmarks), help='benchmarks to run. Defaults to all of them')
+    parser.add_argument('--files', nargs='+', default=None, help='corpus files to run on. Defaults to all of them')
+    parser.add_argument('--repeat', default=3, type=int, help='number of timed runs of each benchmark, of which the fastest is kept. Defaults to 3')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure peak memory with tracemalloc")
+    parser.add_argument('--seed', default=0, type=int, help='seed for the synthetic corpus. Defaults to 0')
+    parser.add_argument('--corpus-dir', type=str, default=None, help='directory to keep the corpus in. Defaults to a temporary directory')
+    parser.add_argument('-o', '--output', type=str, default=None, help='file to save the results to as JSON')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results to compare with. Exits with status 1 if anything regressed')
+    parser.add_argument('--threshold', default=0.10, type=float, help='fraction slower than the baseline that counts as a regression. Defaults to 0.10')
+    parser.add_argument('--memory-threshold', default=0.10, type=float, help='fraction more peak memory than the baseline that counts as a regression. Defaults to 0.10')
+    args = parser.parse_args()
+
+    corpus = quick_corpus if args.quick else default_corpus
+    if args.files:
+        corpus = {name: spec for (name, spec) in corpus.items() if name in args.files}
+    with contextlib.ExitStack() as stack:
+        if args.corpus_dir:
+            corpus_dir = Path(args.corpus_dir)
+        else:
+            corpus_dir = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        workdir = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        start = time.perf_counter()
+        files = make_corpus(corpus_dir, corpus, args.seed)
+        print(f'Generated {len(files)} corpus files in {time.perf_counter() - start:.1f}s')
+
+        results = {}
+        print(f'{"benchmark":<28}{"seconds":>10}{"Mpixels/s":>11}{"MB/s":>9}{"peak MB":>9}')
+        for (file_name, entry) in files.items():
+            for bench_name in args.benchmarks:
+                name = f'{bench_name}/{file_name}'
+                if bench_name in setups:
+                    setups[bench_name](entry)
+                result = measure(benchmarks[bench_name], entry, workdir, args.repeat, not args.no_memory)
+                results[name] = result
+                peak = f'{result["peak_mb"]:>9.1f}' if 'peak_mb' in result else ''
+                print(f'{name:<28}{result["seconds"]:>10.4f}{result["pixels_per_s"] / 1e6:>11.2f}{result["mb_per_s"]:>9.2f}{peak}')
+
+    report = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'settings': {'seed': args.seed, 'repeat': args.repeat, 'corpus': {name: list(spec) for (name, spec) in corpus.items()}},
+        'results': results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=4))
+        print(f'Saved results to {args.output}')
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline.get('settings', {}).get('corpus') != report['settings']['corpus']:
+            print('Warning: the baseline was run on a different corpus')
+        regressions = compare(results, baseline['results'], args.threshold, args.memory_threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+        print(f'No regressions against {args.baseline}')
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+Round trip and differential fuzzer for the TGR codec.
+
+Random and adversarial frames are packed with tgrtool pack, alongside
+a padding frame and a flipped copy, then packed again with the frames
+taken from the encode cache, which has to give the same file. The file
+is decoded by the reference extractLine, by the vectorised decodeFrame
+and by tgrtool unpack. Every decoded pixel has to match the other
+decoders and the frame as the encoder quantises it. Random run data
+that the encoder never writes is also decoded each way, with and
+without fx_error_fix.
+
+Failing frames are shrunk to as few rows, columns and visible pixels
+as still fail, and saved with the .TGR they pack to.
+
+    python fuzztgr.py --cases 200 --seed 1 -o fuzz_failures
+"""
+
+import argparse
+import contextlib
+import json
+import random
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+import tgrlib
+import tgrtool
+from pathlib import Path
+from PIL import Image
+
+sprite_ini = """[BitDepth]
+Depth = {depth}
+[HotSpot]
+X = 0
+Y = 0
+[BoundingBox]
+XMin = 0
+YMin = 0
+XMax = 0
+YMax = 0
+[PaddingFrames]
+FrameList = 1
+[Animation0]
+StartFrame = 0
+FrameCount = 3
+AnimationCount = 1
+"""
+
+# Encoder settings each frame is packed with, as bits per pixel,
+# --optimize and --jobs
+variants = {
+    'greedy': (16, False, 1),
+    'optimize': (16, True, 1),
+    'palette': (8, False, 1),
+    'palette-optimize': (8, True, 1),
+    'jobs': (16, False, 2),
+}
+
+def random_color(rng: np.random.Generator):
+    return [int(v) for v in rng.integers(0, 256, 3)]
+
+def random_segment(rng: np.random.Generator, length: int, color: int):
+    """Pixels for one stretch of a row, using one kind of run"""
+    shades = sorted(tgrlib.player_cols[color])
+    segment = np.zeros((length, 4), dtype=np.uint8)
+    kind = rng.integers(0, 10)
+    if kind == 0:       # transparent
+        pass
+    elif kind == 1:     # shadow
+        segment[:] = tuple(tgrlib.shadow.values())
+    elif kind == 2:     # opaque run of one colour
+        segment[:] = random_color(rng) + [255]
+    elif kind == 3:     # opaque noise, with some neighbours repeated
+        segment[:, :3] = rng.integers(0, 256, (length, 3))
+        segment[:, 3] = 255
+        repeats = rng.random(length) < 0.3
+        for i in np.flatnonzero(repeats[1:]) + 1:
+            segment[i] = segment[i - 1]
+    elif kind == 4:     # translucent run of one colour
+        segment[:] = random_color(rng) + [int(rng.integers(1, 255))]
+    elif kind == 5:     # translucent noise
+        segment[:, :3] = rng.integers(0, 256, (length, 3))
+        segment[:, 3] = rng.integers(1, 256, length)
+    elif kind == 6:     # player colours
+        for i in range(length):
+            segment[i] = tuple(tgrlib.player_cols[color][int(rng.choice(shades))].values())
+    elif kind == 7:     # odd player shades, which can be packed two to a byte
+        odd = [shade for shade in shades if shade % 2 == 1]
+        for i in range(length):
+            segment[i] = tuple(tgrlib.player_cols[color][int(rng.choice(odd))].values())
+    elif kind == 8:     # translucent player colours
+        for i in range(length):
+            (r, g, b, _) = tgrlib.player_cols[color][int(rng.choice(shades))].values()
+            segment[i] = (r, g, b, int(rng.integers(1, 255)))
+    else:               # two colours alternating
+        pair = np.array([random_color(rng) + [255], random_color(rng) + [255]], dtype=np.uint8)
+        segment[:] = pair[rng.integers(0, 2, length)]
+    return segment
+
+def random_frame(rng: np.random.Generator, color: int, width=None, height=None):
+    """An RGBA frame made of random segments, with run lengths around the
+    31 and 23 pixel limits of the run headers"""
+    width = width or int(rng.integers(1, 120))
+    height = height or int(rng.integers(1, 24))
+    frame = np.zeros((height, width, 4), dtype=np.uint8)
+    lengths = [1, 2, 3, 22, 23, 24, 27, 28, 30, 31, 32, 33, 62, 63]
+    for row in frame:
+        x = 0
+        while x < width:
+            length = int(rng.choice(lengths)) if rng.random() < 0.5 else int(rng.integers(1, 40))
+            length = min(length, width - x)
+            row[x:x + length] = random_segment(rng, length, color)
+            x += length
+    # Frames have to have a visible pixel to be cropped to
+    if not (frame[..., 3] > 0).any():
+        frame[int(rng.integers(0, height)), int(rng.integers(0, width))] = random_color(rng) + [255]
+    return frame
+
+def adversarial_frames(rng: np.random.Generator, color: int):
+    """Frames at the limits of the line header and run lengths"""
+    frames = {}
+    # Lines of opaque noise with close to the 0x7FFA bytes a line can hold
+    width = 0x7FFA // 2 - 0x7FFA // 64 - 16
+    noise = np.empty((1, width, 4), dtype=np.uint8)
+    noise[..., :3] = rng.integers(0, 256, (1, width, 3))
+    noise[..., 3] = 255
+    frames['longest-literal-line'] = noise
+    # Lines with close to the 0x7FFF pixels a line can hold
+    wide = np.zeros((2, 0x7FFF, 4), dtype=np.uint8)
+    wide[0, ::97] = random_color(rng) + [255]
+    wide[1, 1:-1] = tuple(tgrlib.shadow.values())
+    wide[:, 0] = wide[:, -1] = random_color(rng) + [255]
+    frames['widest-line'] = wide
+    # Leading transparency either side of the 127 and 255 pixel offsets
+    # that need a longer line header, and pixels after 31, 62 and 93
+    # transparent pixels, with the rest of the row transparent
+    offsets = np.zeros((9, 400, 4), dtype=np.uint8)
+    for (row, (x, gap)) in enumerate(((127, 31), (128, 62), (255, 93), (256, 31), (300, 62), (31, 93), (62, 30), (63, 32))):
+        offsets[row, x] = random_color(rng) + [255]
+        offsets[row, x + gap + 1] = random_color(rng) + [255]
+    offsets[-1, 0] = offsets[-1, -1] = random_color(rng) + [255]
+    frames['transparent-runs'] = offsets
+    # Every player shade, opaque and translucent
+    shades = sorted(tgrlib.player_cols[color])
+    player = np.zeros((2, len(shades), 4), dtype=np.uint8)
+    for (x, shade) in enumerate(shades):
+        (r, g, b, _) = tgrlib.player_cols[color][shade].values()
+        player[0, x] = (r, g, b, 255)
+        player[1, x] = (r, g, b, 1 + 8 * x % 254)
+    frames['player-shades'] = player
+    return frames
+
+def quantised_frame(pixels: np.ndarray, color: int, palette: tgrlib.Palette|None=None) -> np.ndarray:
+    """The pixels a frame should decode to once packed, from the
+    quantisation done by the encoder. Pixels with no alpha are zeroed"""
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    (_, kinds, shades) = tgrlib.classify_pixels(pixels, color)
+    words = tgrlib.rgba_to_rgb565(pixels)
+    if palette is not None:
+        words = palette.words[palette.lut[words]]
+    alpha = tgrlib.alpha_5_to_8[tgrlib.quantise_5_array[pixels[..., 3]]].astype(np.uint8)
+    player_rgba = np.zeros((33, 4), dtype=np.uint8)
+    for (shade, p) in tgrlib.player_cols[color].items():
+        player_rgba[shade] = tuple(p.values())
+
+    out = np.zeros_like(pixels)
+    colour = (kinds == tgrlib.PX_OPAQUE) | (kinds == tgrlib.PX_TRANSLUCENT)
+    out[colour] = tgrlib.rgb565_rgba[words[colour]]
+    player = (kinds == tgrlib.PX_PLAYER) | (kinds == tgrlib.PX_PLAYER_TRANSLUCENT)
+    out[player] = player_rgba[shades[player]]
+    translucent = (kinds == tgrlib.PX_TRANSLUCENT) | (kinds == tgrlib.PX_PLAYER_TRANSLUCENT)
+    out[translucent, 3] = alpha[translucent]
+    out[kinds == tgrlib.PX_SHADOW] = tuple(tgrlib.shadow.values())
+    out[out[..., 3] == 0] = 0
+    return out
+
+def source_frames(pixels: np.ndarray):
+    """The frames of the source packed for a frame: the frame, a padding
+    frame and the frame upside down, which crops differently"""
+    return [pixels, None, np.ascontiguousarray(pixels[::-1])]
+
+def write_source(source: Path, pixels: np.ndarray, depth: int):
+    source.mkdir(parents=True, exist_ok=True)
+    for (frame_index, frame) in enumerate(source_frames(pixels)):
+        image = Image.new('RGBA', (1, 1)) if frame is None else Image.fromarray(frame)
+        image.save(source / f'fram_{frame_index:04d}.png')
+    (source / 'sprite.ini').write_text(sprite_ini.format(depth=depth))
+
+def pack_frame(pixels: np.ndarray, color: int, variant: str, workdir: Path, name='fuzz.tgr') -> Path:
+    """Pack the source for a frame with tgrtool pack, returning the .TGR
+    path. Encoded frames are cached in workdir, so packing a frame again
+    takes it from the cache"""
+    (depth, optimize, jobs) = variants[variant]
+    source = workdir / 'source'
+    shutil.rmtree(source, ignore_errors=True)
+    write_source(source, pixels, depth)
+    outfile = workdir / name
+    argv = ['pack', '-c', str(color), '--depth', str(depth), '-j', str(jobs),
+            '--cache-dir', str(workdir / 'cache'), '-o', str(outfile), str(source)]
+    if optimize:
+        argv.insert(1, '--optimize')
+    tgrtool.run(tgrtool.main_parse.parse_args(argv), on_event=tgrlib.ignore_event)
+    return outfile
+
+def unpacked_frames(tgr_path: Path, color: int, padding: list, fx_error_fix=False):
+    """Unpack a file with tgrtool unpack, giving its frames as the PNGs
+    it writes, or None for the frames in padding"""
+    dest = tgr_path.parent / 'unpacked'
+    shutil.rmtree(dest, ignore_errors=True)
+    argv = ['unpack', '-c', str(color), '--compress-level', '0', '-o', str(dest), str(tgr_path)]
+    if fx_error_fix:
+        argv.insert(1, '--fx-error-fix')
+    tgrtool.run(tgrtool.main_parse.parse_args(argv), on_event=tgrlib.ignore_event)
+    frames = []
+    for frame_index in range(len(padding)):
+        if padding[frame_index]:
+            frames.append(None)
+            continue
+        with Image.open(dest / f'fram_{frame_index:04d}.png') as f:
+            pixels = np.array(f.convert('RGBA'))
+        pixels[pixels[..., 3] == 0] = 0
+        frames.append(pixels)
+    return frames
+
+def reference_frame(imagefile: tgrlib.tgrFile, frame_index: int, color: int, fx_error_fix=False) -> np.ndarray:
+    """Decode a frame a line at a time with extractLine"""
+    frame = imagefile.frames[frame_index]
+    (width, height) = frame.size
+    rows = []
+    with open(imagefile.filename, 'rb') as fh:
+        for line_index in range(height):
+            line = imagefile.extractLine(fh, frame_index=frame_index, line_index=line_index, color=color, fx_error_fix=fx_error_fix)
+            line = (line + [tgrlib.transparency] * width)[:width]
+            rows.append(b''.join(p.pack_to_bin('RGBA') for p in line))
+    return np.frombuffer(b''.join(rows), dtype=np.uint8).reshape(height, width, 4)
+
+def decoded_frames(tgr_path: Path, color: int, fx_error_fix=False):
+    """Decode every frame of a file with each decoder and with tgrtool
+    unpack, giving a dict of the frames from each, placed on a canvas of
+    the file's size"""
+    results = {}
+    for (name, mapped) in (('extractLine', False), ('decodeFrame', False), ('decodeFrame-mapped', True)):
+        imagefile = tgrlib.tgrFile(tgr_path, mapped=mapped, on_event=tgrlib.ignore_event)
+        imagefile.load()
+        frames = []
+        for frame_index in range(len(imagefile.frames)):
+            if imagefile.framesizes[frame_index][2] == 0:
+                frames.append(None)
+                continue
+            if name == 'extractLine':
+                pixels = reference_frame(imagefile, frame_index, color, fx_error_fix)
+            else:
+                pixels = imagefile.decodeFrame(frame_index, color, fx_error_fix)
+            ((ulx, uly), _) = imagefile.frameoffsets[frame_index]
+            (height, width) = pixels.shape[:2]
+            canvas = np.zeros((max(imagefile.size[1], uly + height), max(imagefile.size[0], ulx + width), 4), dtype=np.uint8)
+            canvas[uly:uly + height, ulx:ulx + width] = pixels
+            canvas[canvas[..., 3] == 0] = 0
+            frames.append(canvas)
+        imagefile.close()
+        results[name] = frames
+    results['unpack'] = unpacked_frames(tgr_path, color, [frame is None for frame in frames], fx_error_fix)
+    return results
+
+def first_difference(a: np.ndarray, b: np.ndarray) -> str:
+    if a.shape != b.shape:
+        return f'shape {a.shape} != {b.shape}'
+    (y, x) = np.argwhere((a != b).any(axis=2))[0]
+    count = int((a != b).any(axis=2).sum())
+    return f'{count} pixels differ, first at x={x} y={y}: {a[y, x].tolist()} != {b[y, x].tolist()}'
+
+def check_frame(pixels: np.ndarray, color: int, variant: str, workdir: Path):
+    """Round trip a frame, returning a description of the first mismatch,
+    or None if it decodes as expected"""
+    try:
+        tgr_path = pack_frame(pixels, color, variant, workdir)
+        if pack_frame(pixels, color, variant, workdir, 'cached.tgr').read_bytes() != tgr_path.read_bytes():
+            return 'packing with the frames from the encode cache gives a different file'
+        frames = source_frames(pixels)
+        palette = None
+        if variants[variant][0] == 8:
+            histogram = sum(tgrlib.color_histogram(frame, color) for frame in frames if frame is not None)
+            palette = tgrlib.median_cut_palette(histogram)
+        expected = [None if frame is None else quantised_frame(frame, color, palette) for frame in frames]
+        results = decoded_frames(tgr_path, color)
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+    for (name, decoded) in results.items():
+        if len(decoded) != len(expected):
+            return f'{name} gives {len(decoded)} frames, not {len(expected)}'
+        for (frame_index, (frame, source)) in enumerate(zip(decoded, expected)):
+            if (frame is None) != (source is None):
+                return f'{name} frame {frame_index} is {"" if frame is None else "not "}a padding frame'
+            if source is not None and (frame.shape != source.shape or not np.array_equal(frame, source)):
+                return f'{name} frame {frame_index} differs from the quantised source: {first_difference(frame, source)}'
+    return None
+
+def shrink(pixels: np.ndarray, fails) -> np.ndarray:
+    """Make a failing frame smaller while fails(frame) stays true: keep the
+    fewest rows, then trim columns, then clear as many visible pixels as
+    possible, in halving chunks"""
+    # One row at a time, then the rows from the first failing one
+    for y in range(pixels.shape[0]):
+        if fails(pixels[y:y + 1]):
+            pixels = pixels[y:y + 1]
+            break
+    for side in ('left', 'right'):
+        step = pixels.shape[1] // 2
+        while step > 0:
+            trimmed = pixels[:, step:] if side == 'left' else pixels[:, :-step]
+            if trimmed.shape[1] > 0 and (trimmed[..., 3] > 0).any() and fails(trimmed):
+                pixels = trimmed
+            else:
+                step //= 2
+    visible = np.argwhere(pixels[..., 3] > 0)
+    chunk = max(len(visible) // 2, 1)
+    while chunk >= 1 and len(visible) > 1:
+        cleared_any = False
+        for start in range(0, len(visible), chunk):
+            candidate = pixels.copy()
+            for (y, x) in visible[start:start + chunk]:
+                candidate[y, x] = 0
+            if (candidate[..., 3] > 0).any() and fails(candidate):
+                pixels = candidate
+                cleared_any = True
+        visible = np.argwhere(pixels[..., 3] > 0)
+        if not cleared_any:
+            chunk //= 2
+    return pixels
+
+def save_failure(outdir: Path, name: str, pixels: np.ndarray, color: int, variant: str, message: str, workdir: Path):
+    """Save a minimised failure as its source frame, the .TGR it packs to and a description"""
+    dest = outdir / name
+    write_source(dest, pixels, variants[variant][0])
+    with contextlib.suppress(Exception):
+        shutil.copy(pack_frame(pixels, color, variant, workdir), dest / f'{name}.tgr')
+    (dest / 'failure.json').write_text(json.dumps({'color': color, 'variant': variant, 'size': pixels.shape[1::-1], 'error': message}, indent=4))
+    print(f'  saved {pixels.shape[1]}x{pixels.shape[0]} repro to {dest}')
+
+def random_run_data(rng: random.Random, bits_per_px: int, fx_markers: bool):
+    """Random lines of run data, including runs the encoder never writes.
+    Returns the FRAM data and the width it needs"""
+    px_bytes = bits_per_px // 8
+    lines = []
+    width = 1
+    for _ in range(rng.randint(1, 12)):
+        data = b''
+        pixels = 0
+        for _ in range(rng.randint(0, 10)):
+            flag = rng.randint(0, 7)
+            n = rng.randint(0, 31)
+            if fx_markers and rng.random() < 0.1:
+                data += bytes([rng.choice((0x7F, 0xFD))])
+                pixels += 1
+            elif flag in (0, 5):
+                data += bytes([flag << 5 | n])
+                pixels += n
+            elif flag == 1:
+                data += bytes([0x20 | n]) + rng.randbytes(px_bytes)
+                pixels += n
+            elif flag == 2:
+                data += bytes([0x40 | n]) + rng.randbytes(px_bytes * n)
+                pixels += n
+            elif flag == 3 and n not in (31,):
+                data += bytes([0x60 | n, rng.randrange(256)]) + rng.randbytes(px_bytes)
+                pixels += n
+            elif flag == 4:
+                data += bytes([0x80 | n]) + rng.randbytes(px_bytes)
+                pixels += 1
+            elif flag == 6:
+                data += bytes([0xC0 | rng.randint(1, 31)])
+                pixels += 1
+            elif flag == 7 and n <= 27:
+                data += bytes([0xE0 | n]) + rng.randbytes((n + 1) // 2)
+                pixels += n
+            elif flag == 7 and n != 29:
+                # The colour index can't be 0, which has no player colour
+                byte = rng.randrange(256)
+                if (byte >> 3 & 0b11100) | (n & 3) == 0:
+                    byte |= 0x20
+                data += bytes([0xE0 | n, byte])
+                pixels += 1
+        offset = rng.randint(0, 40)
+        lines.append(tgrlib.encode_line_header(0, len(lines), data, pixels, offset))
+        width = max(width, offset + pixels)
+    data = b''.join(lines)
+    return (data + b'\x00' * (-len(data) % 4), width, len(lines))
+
+def write_raw_tgr(path: Path, rng: random.Random, bits_per_px: int, fx_markers: bool):
+    """A one frame .TGR holding random run data, with a random palette for 8 bit files"""
+    (data, width, height) = random_run_data(rng, bits_per_px, fx_markers)
+    palette = b''
+    if bits_per_px == 8:
+        palette = tgrlib.Palette(np.array([rng.randrange(0x10000) for _ in range(256)])).pack()
+    hedr_length = 40 + 12 + 4
+    palette_offset = 12 + 8 + hedr_length + 8 if palette else 0
+    fram_offset = 12 + 8 + hedr_length + len(palette) + 8
+    hedr = struct.pack('I12HIII', 4, 1, bits_per_px, 0x1A00 if bits_per_px == 8 else 0, 0,
+                       width, height, 0, 0, 0, 0, 0, 0, 0, 0, palette_offset)
+    hedr += struct.pack('4HI', 0, 0, width - 1, height - 1, fram_offset)
+    hedr += struct.pack('<H', 0) + b'\x00\x00'
+    body = struct.pack('>4sI', b'HEDR', len(hedr)) + hedr + palette + struct.pack('>4sI', b'FRAM', len(data)) + data
+    path.write_bytes(struct.pack('>4sI4s', b'FORM', len(body), b'TGAR') + body)
+
+def check_raw(path: Path, color: int, fx_error_fix: bool):
+    try:
+        results = decoded_frames(path, color, fx_error_fix)
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+    reference = results.pop('extractLine')[0]
+    for (name, frames) in results.items():
+        if frames[0].shape != reference.shape or not np.array_equal(frames[0], reference):
+            return f'{name} differs from extractLine: {first_difference(frames[0], reference)}'
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Round trip random frames through the TGR encoder and decoders')
+    parser.add_argument('--cases', default=100, type=int, help='number of random frames, and of random run data files. Defaults to 100')
+    parser.add_argument('--seed', default=0, type=int, help='seed for the random frames. Defaults to 0')
+    parser.add_argument('--variants', nargs='+', choices=list(variants), default=list(variants), help='encoder settings to pack each frame with. Defaults to all of them')
+    parser.add_argument('--no-adversarial', action='store_true', help='skip the frames at the limits of the format, which are slow to decode with extractLine')
+    parser.add_argument('--no-minimise', action='store_true', help='save failing frames as they are, without shrinking them first')
+    parser.add_argument('-o', '--output', type=str, default='fuzz_failures', help='directory to save failing cases to. Defaults to fuzz_failures')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    raw_rng = random.Random(args.seed)
+    outdir = Path(args.output)
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        cases = []
+        if not args.no_adversarial:
+            cases += [(name, pixels, 2) for (name, pixels) in adversarial_frames(rng, 2).items()]
+        for case in range(args.cases):
+            color = int(rng.integers(1, 12))
+            cases.append((f'random-{args.seed}-{case}', random_frame(rng, color), color))
+
+        for (name, pixels, color) in cases:
+            for variant in args.variants:
+                message = check_frame(pixels, color, variant, workdir)
+                if message is None:
+                    continue
+                failures += 1
+                print(f'{name} {variant} color {color}: {message}')
+                if not args.no_minimise:
+                    pixels = shrink(pixels, lambda frame: check_frame(frame, color, variant, workdir) is not None)
+                    message = check_frame(pixels, color, variant, workdir) or message
+                save_failure(outdir, f'{name}-{variant}', pixels, color, variant, message, workdir)
+
+        for case in range(args.cases):
+            bits_per_px = raw_rng.choice((8, 16))
+            fx_error_fix = raw_rng.random() < 0.5
+            path = workdir / 'raw.tgr'
+            write_raw_tgr(path, raw_rng, bits_per_px, fx_error_fix)
+            color = raw_rng.randint(1, 11)
+            message = check_raw(path, color, fx_error_fix)
+            if message is not None:
+                failures += 1
+                name = f'raw-{args.seed}-{case}'
+                print(f'{name} {bits_per_px} bit fx_error_fix={fx_error_fix} color {color}: {message}')
+                dest = outdir / name
+                dest.mkdir(parents=True, exist_ok=True)
+                shutil.copy(path, dest / f'{name}.tgr')
+                (dest / 'failure.json').write_text(json.dumps({'color': color, 'fx_error_fix': fx_error_fix, 'error': message}, indent=4))
+
+    print(f'{len(cases)} frames with {len(args.variants)} encoder settings and {args.cases} run data files checked, {failures} failures')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -2,6 +2,7 @@
 
 import struct
 import io
+import mmap
 from pathlib import Path
 
 class chunk:
@@ -57,17 +58,47 @@ class chunk:
         return None
 
 class iff_file:
-    def __init__(self, filename):
+    """An IFF file on disk. If mapped is set the file is opened once
+    and memory mapped, and chunk data is returned as memoryview slices
+    of the mapping instead of being read into new bytes objects."""
+    def __init__(self, filename, mapped=False):
         self.data = chunk()
         self.filename = filename
+        self.mapped = mapped
+        self.buffer = None
+
+    def open(self):
+        if self.buffer is None:
+            with Path(self.filename).open(mode="rb") as in_fh:
+                self.buffer = mmap.mmap(in_fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.buffer
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
 
     def load(self):
-        in_file = Path(self.filename)
-        
-        with in_file.open(mode="rb") as in_fh:
+        if self.mapped:
+            in_fh = self.open()
+            in_fh.seek(0)
             errval = self.data.parse(in_fh)
-            if errval != None:
-                print(errval)
+        else:
+            with Path(self.filename).open(mode="rb") as in_fh:
+                errval = self.data.parse(in_fh)
+        # parse errors are returned for the caller to report
+        return errval
+
+    def read(self, offset, length):
+        """Get length bytes of the file starting at offset"""
+        if self.mapped:
+            return memoryview(self.open())[offset:offset + length]
+        with Path(self.filename).open(mode="rb") as in_fh:
+            in_fh.seek(offset)
+            return in_fh.read(length)
+
+    def chunk_data(self, chunk):
+        return self.read(chunk.data_offset, chunk.length)
 
     def dump(self, outdirname=None):
         filepath = Path(self.filename)
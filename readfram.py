@@ -39,31 +39,12 @@ if __name__ == "__main__":
     # frame = imagefile.frames[frame_index]
 
         print(frame_index, frame.size)
+        imagedata = imagefile.get_frame(frame_index, color=player_color)
         if args.no_align_frames:
-            image = Image.new(pixel_format, frame.size)
+            image = Image.fromarray(imagedata)
         else:
             image = Image.new(pixel_format, imagefile.size)
-            fram_img = Image.new(pixel_format, frame.size)
-        imagedata = b""
-        with open(image_path, "rb") as in_fh:
-            for idx in range(len(frame.lines)):
-                rawline = imagefile.extractLine(in_fh, frame_index=frame_index, line_index=idx, increment=0, color=player_color)
-                #print(f"{idx+1:3d}: 0x{frame.lines[idx].offset:06x}, {len(rawline)}")
-                if len(rawline) < frame.size[0]:
-                    rawline += [tgrlib.transparency for _ in range(frame.size[0] - len(rawline))]
-                #while len(rawline) < frame.size[0]:
-                #    rawline.append(tgrlib.Pixel(0, 0, 0))
-                if len(rawline) > frame.size[0]:
-                    rawline = rawline[0:frame.size[0]]
-                imagedata += b"".join([elem.pack_to_bin(pixel_format) for elem in rawline])
-                #print(len(imagedata))
-        target_len = (frame.size[0] * frame.size[1]) * (3 if format == "RGB" else 4)
-        if len(imagedata) < target_len:
-            imagedata += bytes([0x00 for _ in range(target_len - len(imagedata))])
-        if args.no_align_frames:
-            image.frombytes(imagedata)
-        else:
-            fram_img.frombytes(imagedata)
+            fram_img = Image.fromarray(imagedata)
             offset = imagefile.frameoffsets[frame_index][0]
             image.paste(fram_img, offset)
         image.save(f"{image_name}/fram_{frame_index:04d}.png")
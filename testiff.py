@@ -14,7 +14,9 @@ if __name__ == "__main__":
         
     f = ifflib.iff_file(sys.argv[1])
 
-    f.load()
+    errval = f.load()
+    if errval != None:
+        print(errval)
     d = f.data
     print(d.type)
     print(d.length)
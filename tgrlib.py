@@ -1,30 +1,74 @@
 #!/usr/bin/python
 
+# Annotations aren't evaluated, so they don't import numpy or PIL
+from __future__ import annotations
+
 import ifflib
+import importlib
+import os
 import struct
 import io
+import json
 import re
 import sys
-import typing
-import numpy as np
+import threading
+import time
 from dataclasses import dataclass
 from pathlib import Path
-from PIL import Image
-from configparser import ConfigParser
-from collections import OrderedDict
-
-# check if running as a PyInstaller exe
-try:
-    import pyi_splash
-    is_exe = True
-    pyi_splash.close()
-except Exception:
-    is_exe = False
+from collections import OrderedDict, deque
+from functools import cached_property, partial
+
+class LazyModule:
+    """Stands in for a module until one of its attributes is used, so
+    commands that don't need the module don't pay for importing it.
+    importlib.util.LazyLoader isn't thread safe before Python 3.12, and
+    frames are loaded from a thread pool, so this imports the module the
+    normal way, under the import lock, and keeps each attribute it hands
+    out"""
+    def __init__(self, name: str):
+        self.__name__ = name
+
+    def __getattr__(self, attr: str):
+        value = getattr(importlib.import_module(self.__name__), attr)
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        return f'<lazy module {self.__name__!r}>'
+
+def lazy_import(name: str):
+    """The module called name, imported when first used"""
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+# Not needed to read a file's header, so these are lazy too
+configparser = lazy_import('configparser')
+futures = lazy_import('concurrent.futures')
+hashlib = lazy_import('hashlib')
+typing = lazy_import('typing')
+
+# check if running as a PyInstaller exe. Only a frozen exe
+# can have pyi_splash, so it isn't looked for otherwise
+is_exe = False
+if getattr(sys, 'frozen', False):
+    try:
+        import pyi_splash
+        is_exe = True
+        pyi_splash.close()
+    except Exception:
+        pass
 
 #is_exe=True
 verbose = False
+# Set to a CodecStats to count the runs read and written and time each stage
+stats = None
 
 frame_number_re = re.compile(r"fram_(\d{1,4})")
+# Sidecar describing where each frame sits in the pages of an unpacked atlas
+atlas_name = 'atlas.json'
 
 max_alpha = lambda p: Pixel(*(p.values()[:3]))
 
@@ -62,6 +106,414 @@ def getRunData(byte):
     length = byte & 31
     return (flag, length)
 
+# Lookup tables between 8 bit colour channels and the 5 and 6 bit
+# channels of 16 bit colour, so no float division is done per pixel
+expand_5 = [round(v / 31 * 255) for v in range(32)]
+expand_6 = [round(v / 63 * 255) for v in range(64)]
+quantise_5 = [round(v / 255 * 31) for v in range(256)]
+quantise_6 = [round(v / 255 * 63) for v in range(256)]
+
+def build_rgb565_table():
+    """Build a (65536, 4) array of the RGBA8888 value of every 16 bit colour"""
+    words = np.arange(0x10000)
+    table = np.empty((0x10000, 4), dtype=np.uint8)
+    table[:, 0] = np.take(expand_5, words >> 11)
+    table[:, 1] = np.take(expand_6, (words >> 5) & 0b111111)
+    table[:, 2] = np.take(expand_5, words & 0b11111)
+    table[:, 3] = 0xff
+    return table
+
+_colour_tables = None
+
+def get_colour_tables():
+    """
+    The numpy colour tables, built the first time they are needed:
+    rgb565_rgba, the RGBA value of every 16 bit colour, rgb565_packed,
+    the same table with each entry packed into one little-endian int,
+    quantise_5_array and quantise_6_array, and alpha_5_to_8, 5 bit
+    alpha values expanded to 8 bits as done by extractLine.
+    They can also be used as attributes of the module
+    """
+    global _colour_tables
+    if _colour_tables is None:
+        rgb565_rgba = build_rgb565_table()
+        _colour_tables = (rgb565_rgba,
+                          rgb565_rgba.view('<u4').ravel(),
+                          np.array(quantise_5, dtype=np.uint16),
+                          np.array(quantise_6, dtype=np.uint16),
+                          np.array(expand_5, dtype=np.uint32))
+    return _colour_tables
+
+colour_table_names = ('rgb565_rgba', 'rgb565_packed', 'quantise_5_array', 'quantise_6_array', 'alpha_5_to_8')
+
+def __getattr__(name: str):
+    """Build the colour and player colour tables when code outside the
+    module first uses them, as they aren't made on import"""
+    if name in colour_table_names:
+        return get_colour_tables()[colour_table_names.index(name)]
+    if name == 'player_cols':
+        return get_player_colors()
+    if name == 'player_shades':
+        return get_player_shades()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def rgba_to_rgb565(pixels: np.ndarray) -> np.ndarray:
+    """Quantise an array of RGB(A) pixels to 16 bit colour values,
+    ignoring alpha. Vectorised equivalent of Pixel.to_int"""
+    (_, _, quantise_5_array, quantise_6_array, _) = get_colour_tables()
+    return ((quantise_5_array[pixels[..., 0]] << 11) |
+            (quantise_6_array[pixels[..., 1]] << 5) |
+            quantise_5_array[pixels[..., 2]])
+
+# Run kinds used by decode_frame_data. These follow the run flags,
+# except for the two forms of 0b111 and the fx_error_fix markers
+RUN_TRANSPARENT = 0b000
+RUN_REPEAT = 0b001
+RUN_LITERAL = 0b010
+RUN_TRANSLUCENT_REPEAT = 0b011
+RUN_TRANSLUCENT = 0b100
+RUN_SHADOW = 0b101
+RUN_PLAYER = 0b110
+RUN_PLAYER_PACKED = 0b111
+RUN_PLAYER_TRANSLUCENT = 8
+RUN_FX_ERROR = 9
+
+_run_tables = {}
+
+def get_run_tables(bits_per_px=16, fx_error_fix=False):
+    """
+    Tables indexed by run header byte, giving the number of bytes
+    the run takes up (header included), the number of pixels it
+    produces, its run kind, the offset from the header to its colour
+    value, and its alpha if the header is enough to know it
+    """
+    key = (bits_per_px, fx_error_fix)
+    if key not in _run_tables:
+        px_bytes = bits_per_px // 8
+        steps = []
+        counts = np.zeros(256, dtype=np.int64)
+        kinds = np.zeros(256, dtype=np.int64)
+        value_offsets = np.ones(256, dtype=np.int64)
+        alphas = np.full(256, 0xff, dtype=np.uint32)
+        for byte in range(256):
+            (flag, run_length) = getRunData(byte)
+            kind = flag
+            count = run_length
+            step = 1
+            if fx_error_fix and byte in (0x7F, 0xFD):
+                kind = RUN_FX_ERROR
+                count = 1
+            else:
+                match flag:
+                    case 0b001:
+                        step += px_bytes
+                    case 0b010:
+                        step += px_bytes * run_length
+                    case 0b011:
+                        step += 1 + px_bytes
+                        value_offsets[byte] = 2
+                    case 0b100:
+                        step += px_bytes
+                        count = 1
+                        alphas[byte] = expand_5[run_length]
+                    case 0b110:
+                        count = 1
+                    case 0b111:
+                        if run_length > 27:
+                            kind = RUN_PLAYER_TRANSLUCENT
+                            step += 1
+                            count = 1
+                        else:
+                            step += (run_length + 1) // 2
+            if kind in (RUN_TRANSPARENT, RUN_FX_ERROR):
+                alphas[byte] = 0
+            elif kind == RUN_SHADOW:
+                alphas[byte] = 0x80
+            steps.append(step)
+            counts[byte] = count
+            kinds[byte] = kind
+        _run_tables[key] = (steps, counts, kinds, value_offsets, alphas)
+    return _run_tables[key]
+
+def read_line_header(data, pos: int):
+    """Read one of the 1 or 2 byte values from a line header,
+    returning the value and the position after it"""
+    if data[pos] & 0x80 != 0:
+        return ((data[pos] & 0x7f) << 8) | data[pos + 1], pos + 2
+    return data[pos], pos + 1
+
+def scan_run_headers(data, height: int, steps: list):
+    """Walk the line and run headers of a frame, using the steps table from
+    get_run_tables. Returns the position of every run header, and for each
+    line the index of its first run, its leading transparent pixels and
+    the size of its line header"""
+    headers = []
+    append = headers.append
+    lines = []
+    pos = 0
+    for _ in range(height):
+        line_start = pos
+        (line_length, pos) = read_line_header(data, pos)
+        (transparent_pixels, pos) = read_line_header(data, pos)
+        (_, pos) = read_line_header(data, pos)
+        end = line_start + line_length
+        lines.append((len(headers), transparent_pixels, pos - line_start))
+        while pos < end:
+            append(pos)
+            pos += steps[data[pos]]
+        pos = end
+    return (headers, lines)
+
+# Names of the run flags, as reported by CodecStats
+run_flag_names = ('transparent', 'repeat', 'literal', 'translucent repeat',
+                  'translucent', 'shadow', 'player', 'player packed')
+
+class CodecStats:
+    """
+    Counts of the runs and line headers read or written, and the wall
+    time spent in each stage of an unpack or pack. Runs are counted by
+    their header byte, which holds both the run flag and the 5 bit length
+    field. For the single pixel flags that field is an alpha or a player
+    shade rather than a length, and the 0x7F and 0xFD fx markers are
+    counted under 0b011 and 0b111.
+    Only collected while the module's stats is set to one of these.
+    """
+    def __init__(self):
+        self.run_counts = np.zeros(256, dtype=np.int64)
+        self.run_bytes = np.zeros(256, dtype=np.int64)
+        self.run_pixels = np.zeros(256, dtype=np.int64)
+        # Lines counted by the size of their header, from 3 to 6 bytes
+        self.header_widths = np.zeros(7, dtype=np.int64)
+        # The seconds taken by each call of a stage, by stage name.
+        # Appending to a list is safe from the PNG save and load threads
+        self.stage_times = {}
+
+    def add_run(self, header: int, run_bytes: int, pixels: int):
+        self.run_counts[header] += 1
+        self.run_bytes[header] += run_bytes
+        self.run_pixels[header] += pixels
+
+    def add_runs(self, headers: np.ndarray, run_bytes: np.ndarray, pixels: np.ndarray):
+        """Count an array of run header bytes, with the bytes and pixels of each run"""
+        self.run_counts += np.bincount(headers, minlength=256)
+        self.run_bytes += np.bincount(headers, weights=run_bytes, minlength=256).astype(np.int64)
+        self.run_pixels += np.bincount(headers, weights=pixels, minlength=256).astype(np.int64)
+
+    def add_line_headers(self, widths):
+        self.header_widths += np.bincount(np.asarray(widths, dtype=np.int64), minlength=7)
+
+    def add_frame_data(self, data, height: int, bits_per_px=16):
+        """Count the runs and line headers of FRAM chunk data, such as
+        the lines written by encode_frame"""
+        (steps, counts, _, _, _) = get_run_tables(bits_per_px)
+        (headers, lines) = scan_run_headers(data, height, steps)
+        header_bytes = np.frombuffer(data, dtype=np.uint8)[np.array(headers, dtype=np.int64)]
+        self.add_runs(header_bytes, np.array(steps)[header_bytes], counts[header_bytes])
+        self.add_line_headers([width for (_, _, width) in lines])
+
+    def add_stage_time(self, name: str, seconds: float):
+        self.stage_times.setdefault(name, []).append(seconds)
+
+    def timer(self):
+        """Returns a function that adds the time since it was last
+        called, or since timer was called, to the stage it is given"""
+        last = time.perf_counter()
+        def lap(name: str):
+            nonlocal last
+            now = time.perf_counter()
+            self.add_stage_time(name, now - last)
+            last = now
+        return lap
+
+    def as_dict(self) -> dict:
+        counts = self.run_counts.reshape(8, 32)
+        flag_runs = counts.sum(axis=1)
+        flag_bytes = self.run_bytes.reshape(8, 32).sum(axis=1)
+        flag_pixels = self.run_pixels.reshape(8, 32).sum(axis=1)
+        flags = {}
+        for (flag, name) in enumerate(run_flag_names):
+            flags[f'0b{flag:03b}'] = {'name': name,
+                                      'runs': int(flag_runs[flag]),
+                                      'bytes': int(flag_bytes[flag]),
+                                      'pixels': int(flag_pixels[flag]),
+                                      'length_field': counts[flag].tolist()}
+        literal_pixels = int(flag_pixels[0b010])
+        repeat_pixels = int(flag_pixels[0b001] + flag_pixels[0b011])
+        colour_pixels = literal_pixels + repeat_pixels
+        return {'runs': int(flag_runs.sum()),
+                'bytes': int(flag_bytes.sum()),
+                'pixels': int(flag_pixels.sum()),
+                'flags': flags,
+                'fx_markers': {'0x7f': int(self.run_counts[0x7F]), '0xfd': int(self.run_counts[0xFD])},
+                'literal_pixels': literal_pixels,
+                'repeat_pixels': repeat_pixels,
+                'literal_ratio': literal_pixels / colour_pixels if colour_pixels else 0.0,
+                'lines': int(self.header_widths.sum()),
+                'line_header_widths': {str(width): int(n) for (width, n) in enumerate(self.header_widths) if width >= 3},
+                'stages': {name: {'seconds': sum(times), 'calls': len(times)} for (name, times) in self.stage_times.items()}}
+
+    def report(self) -> str:
+        """The stats as a printable table"""
+        d = self.as_dict()
+        out = [f'{"flag":<7}{"name":<20}{"runs":>10}{"bytes":>12}{"pixels":>12}{"px/run":>8}']
+        for (flag, f) in d['flags'].items():
+            per_run = f['pixels'] / f['runs'] if f['runs'] else 0
+            out.append(f'{flag:<7}{f["name"]:<20}{f["runs"]:>10}{f["bytes"]:>12}{f["pixels"]:>12}{per_run:>8.1f}')
+        out.append(f'{"":<7}{"total":<20}{d["runs"]:>10}{d["bytes"]:>12}{d["pixels"]:>12}')
+        out.append(f'fx markers: 0x7F {d["fx_markers"]["0x7f"]}, 0xFD {d["fx_markers"]["0xfd"]}')
+        out.append(f'literal pixels: {d["literal_pixels"]}, repeat run pixels: {d["repeat_pixels"]} ({d["literal_ratio"]:.1%} literal)')
+        widths = ', '.join(f'{width} bytes: {n}' for (width, n) in d['line_header_widths'].items() if n)
+        out.append(f'line headers: {d["lines"]} ({widths})')
+        if d['stages']:
+            out.append(f'{"stage":<20}{"seconds":>10}{"calls":>8}')
+            for (name, stage) in d['stages'].items():
+                out.append(f'{name:<20}{stage["seconds"]:>10.3f}{stage["calls"]:>8}')
+        return '\n'.join(out)
+
+def stage_timer():
+    """Returns a function to call with the name of each stage as it
+    finishes, timing them into stats. Does nothing if stats is None"""
+    if stats is None:
+        return lambda name: None
+    return stats.timer()
+
+# Value of FrameLayers.shades for pixels that aren't player coloured
+NO_PLAYER_SHADE = 0xff
+
+@dataclass
+class FrameLayers:
+    """
+    A decoded frame that doesn't depend on the player colour.
+    rgba holds every pixel, but player coloured pixels only have
+    their alpha set. shades holds the player colour shade index of
+    those pixels, and NO_PLAYER_SHADE everywhere else.
+    """
+    rgba: np.ndarray
+    shades: np.ndarray
+
+    @property
+    def nbytes(self):
+        return self.rgba.nbytes + self.shades.nbytes
+
+    def with_color(self, player_lut: np.ndarray) -> np.ndarray:
+        """Fill in the player coloured pixels using a lut from player_color_lut"""
+        lap = stage_timer()
+        is_player = self.shades != NO_PLAYER_SHADE
+        shades = self.shades[is_player]
+        player_rgb = player_lut[shades]
+        if (player_rgb < 0).any():
+            raise KeyError(int(shades[player_rgb < 0][0]))
+        out = self.rgba.copy()
+        packed = out.view('<u4')[..., 0]
+        packed[is_player] |= player_rgb.astype(np.uint32)
+        lap('colour expansion')
+        return out
+
+def decode_frame_data(data, size, bits_per_px=16, colour_table=None, player_lut=None, fx_error_fix=False):
+    """
+    Decode the lines of a FRAM chunk into a (height, width, 4) RGBA array.
+
+    data is the chunk data starting at the first line header. colour_table
+    maps the colour values in the data to packed RGBA values, and defaults
+    to rgb565_packed. 8 bit files should pass their packed palette instead.
+    player_lut is a 32 entry array of packed player colours, with -1 for
+    shades that don't exist.
+    The output matches extractLine padded or cropped to the frame width.
+    """
+    layers = decode_frame_layers(data, size, bits_per_px, colour_table, fx_error_fix)
+    return layers.with_color(player_lut)
+
+def decode_frame_layers(data, size, bits_per_px=16, colour_table=None, fx_error_fix=False) -> FrameLayers:
+    """
+    Decode the lines of a FRAM chunk without applying a player colour,
+    so the same decode can be coloured for any player with
+    FrameLayers.with_color. Arguments are as for decode_frame_data
+    """
+    width, height = size
+    px_bytes = bits_per_px // 8
+    (steps, count_table, kind_table, offset_table, alpha_table) = get_run_tables(bits_per_px, fx_error_fix)
+    (_, rgb565_packed, _, _, alpha_5_to_8) = get_colour_tables()
+    if colour_table is None:
+        colour_table = rgb565_packed
+    out = np.zeros((height, width), dtype='<u4')
+    out_shades = np.full((height, width), NO_PLAYER_SHADE, dtype=np.uint8)
+
+    # Only the run headers are walked in python, as the size of each
+    # run is known from its header byte. Everything else is done on
+    # the arrays of header positions
+    lap = stage_timer()
+    (headers, line_starts) = scan_run_headers(data, height, steps)
+    lap('line index')
+    if stats is not None:
+        stats.add_line_headers([width for (_, _, width) in line_starts])
+    if not headers:
+        return FrameLayers(out.view(np.uint8).reshape(height, width, 4), out_shades)
+
+    raw = np.frombuffer(data, dtype=np.uint8)
+    headers = np.array(headers, dtype=np.int64)
+    header_bytes = raw[headers]
+    run_lengths = header_bytes & 31
+    kinds = kind_table[header_bytes]
+    counts = count_table[header_bytes]
+    if stats is not None:
+        stats.add_runs(header_bytes, np.array(steps)[header_bytes], counts)
+
+    # x position of each run within its line
+    (first_runs, transparent_pixels, _) = np.array(line_starts, dtype=np.int64).T
+    runs_per_line = np.diff(first_runs, append=len(headers))
+    run_starts = np.cumsum(counts) - counts
+    line_base = run_starts[np.minimum(first_runs, len(headers) - 1)] - transparent_pixels
+    cols = run_starts - np.repeat(line_base, runs_per_line)
+    rows = np.repeat(np.arange(height), runs_per_line)
+
+    alphas = alpha_table[header_bytes]
+    rgb = np.zeros(len(headers), dtype=np.uint32)
+    rgb[kinds == RUN_FX_ERROR] = 0xFF00FF
+    has_alpha = (kinds == RUN_TRANSLUCENT_REPEAT) | (kinds == RUN_PLAYER_TRANSLUCENT)
+    alphas[has_alpha] = alpha_5_to_8[raw[headers[has_alpha] + 1] & 31]
+    shades = np.full(len(headers), NO_PLAYER_SHADE, dtype=np.uint8)
+    is_player = kinds == RUN_PLAYER
+    shades[is_player] = run_lengths[is_player]
+    is_player_translucent = kinds == RUN_PLAYER_TRANSLUCENT
+    body = raw[headers[is_player_translucent] + 1]
+    shades[is_player_translucent] = ((body >> 3) & 0b11100) | (run_lengths[is_player_translucent] & 3)
+
+    # expand runs into pixels, skipping transparent runs
+    visible = (kinds != RUN_TRANSPARENT) & (counts > 0)
+    counts = counts[visible]
+    run_ids = np.repeat(np.flatnonzero(visible), counts)
+    run_pos = np.arange(len(run_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+    kinds = kinds[run_ids]
+    pixel_rgb = rgb[run_ids]
+    pixel_shades = shades[run_ids]
+
+    is_colour = (kinds == RUN_REPEAT) | (kinds == RUN_LITERAL) | (kinds == RUN_TRANSLUCENT_REPEAT) | (kinds == RUN_TRANSLUCENT)
+    if is_colour.any():
+        colour_runs = run_ids[is_colour]
+        offsets = headers[colour_runs] + offset_table[header_bytes[colour_runs]]
+        offsets += np.where(kinds[is_colour] == RUN_LITERAL, run_pos[is_colour] * px_bytes, 0)
+        if px_bytes == 1:
+            values = raw[offsets]
+        else:
+            values = raw[offsets].astype(np.uint32) | (raw[offsets + 1].astype(np.uint32) << 8)
+        pixel_rgb[is_colour] = np.take(colour_table, values) & 0xffffff
+    is_packed = kinds == RUN_PLAYER_PACKED
+    if is_packed.any():
+        packed_pos = run_pos[is_packed]
+        packed = raw[headers[run_ids[is_packed]] + 1 + packed_pos // 2]
+        # each byte holds two 4 bit indices, shifted left 1 bit with the least sig bit set
+        pixel_shades[is_packed] = (np.where(packed_pos % 2 == 0, packed >> 4, packed & 0b1111) << 1) | 1
+
+    pixels = pixel_rgb | (alphas[run_ids] << 24)
+    pixel_cols = cols[run_ids] + run_pos
+    in_frame = pixel_cols < width
+    pixel_rows = rows[run_ids][in_frame]
+    pixel_cols = pixel_cols[in_frame]
+    out[pixel_rows, pixel_cols] = pixels[in_frame]
+    out_shades[pixel_rows, pixel_cols] = pixel_shades[in_frame]
+    lap('decode')
+    return FrameLayers(out.view(np.uint8).reshape(height, width, 4), out_shades)
+
 @dataclass
 class Pixel:
     """Class for managing pixel values in different formats"""
@@ -77,9 +529,9 @@ class Pixel:
         # Bitwise AND masks off the unwanted bits to leave
         # only the desired channel.
         
-        blue = round((half_word & 0b11111) / 31 * 255)
-        green = round(((half_word >> 5) & 0b111111) / 63 * 255)
-        red = round(((half_word >> 11) & 0b11111) / 31 * 255)
+        blue = expand_5[half_word & 0b11111]
+        green = expand_6[(half_word >> 5) & 0b111111]
+        red = expand_5[(half_word >> 11) & 0b11111]
 
         return cls(red, green, blue)
     
@@ -87,10 +539,10 @@ class Pixel:
         return Pixel(self.red, self.green, self.blue, self.alpha)
     
     def to_int(self):
-        r5 = round(self.red / 255 * 31)
-        g6 = round(self.green / 255 * 63)
-        b5 = round(self.blue / 255 * 31)
-        a5 = round(self.alpha / 255 * 31)
+        r5 = quantise_5[self.red]
+        g6 = quantise_6[self.green]
+        b5 = quantise_5[self.blue]
+        a5 = quantise_5[self.alpha]
         
         return (r5, g6, b5, a5)
     
@@ -110,7 +562,7 @@ shadow = Pixel(0, 0, 0, 0x80)
 transparency = Pixel(0x00, 0x00, 0x00, 0x00)
 
 def load_player_colors(filename: str = "data/COLORS.INI"):
-    c_file = ConfigParser()
+    c_file = configparser.ConfigParser()
     c_file.read(resource_path(filename))
     player_cols = {}
     c_name_re = re.compile(r"color_(\d{1,2})_shade_(\d{1,2})")
@@ -129,7 +581,106 @@ def load_player_colors(filename: str = "data/COLORS.INI"):
                 player_cols[player_num][shade_num] = Pixel(*i_color)
     return player_cols
 
-player_cols = load_player_colors()
+class PlayerShadeIndex:
+    """
+    Reverse lookup from packed 0xBBGGRR values to the shade numbers of
+    one player colour. Where shades share a value the first one listed
+    is used. shade_of is a dict for single pixels, and keys holds the
+    sorted values for looking up arrays of pixels with searchsorted.
+    Run headers only hold 5 bit shade numbers, so shades from 32 up are
+    left out and packed as ordinary colours
+    """
+    def __init__(self, shades: dict):
+        self.shade_of = {}
+        for shade, p in shades.items():
+            if shade > 31:
+                continue
+            self.shade_of.setdefault(p.red | (p.green << 8) | (p.blue << 16), shade)
+        self.keys = np.array(sorted(self.shade_of), dtype=np.uint32)
+        self.shades = np.array([self.shade_of[k] for k in self.keys.tolist()], dtype=np.int64)
+
+    def shade(self, p: Pixel):
+        """Shade number of a pixel, ignoring alpha, or None if it isn't this colour"""
+        return self.shade_of.get(p.red | (p.green << 8) | (p.blue << 16))
+
+    def lookup(self, rgb: np.ndarray):
+        """Look up an array of packed 0xBBGGRR values, returning whether
+        each is a shade of this colour and the shade numbers, which are
+        0 for values that aren't"""
+        rgb = np.asarray(rgb, dtype=np.uint32)
+        if len(self.keys) == 0:
+            return (np.zeros(rgb.shape, dtype=bool), np.zeros(rgb.shape, dtype=np.int64))
+        ix = np.minimum(np.searchsorted(self.keys, rgb), len(self.keys) - 1)
+        found = self.keys[ix] == rgb
+        return (found, np.where(found, self.shades[ix], 0))
+
+def index_player_colors(player_cols: dict) -> dict:
+    return {color: PlayerShadeIndex(shades) for color, shades in player_cols.items()}
+
+def user_cache_dir() -> Path:
+    return Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'tgrtool'
+
+def load_player_colors_cached(filename: str = "data/COLORS.INI", cache_path: str|None=None):
+    """
+    load_player_colors, going through a JSON copy of the colours kept
+    in the user cache directory, which is much quicker to read than the
+    INI. The copy is keyed by the size and hash of the INI rather than
+    its path, which is a new temporary directory on every run of the
+    one file exe. If the cache can't be written the colours are still
+    returned
+    """
+    ini_data = resource_path(filename).read_bytes()
+    source = {'size': len(ini_data), 'sha1': hashlib.sha1(ini_data).hexdigest()}
+    cache_path = Path(cache_path) if cache_path else user_cache_dir() / 'colors.json'
+    try:
+        cached = json.loads(cache_path.read_text())
+        if cached['source'] == source:
+            return {int(color): {int(shade): Pixel(*rgb) for (shade, rgb) in shades.items()}
+                    for (color, shades) in cached['colors'].items()}
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    player_cols = load_player_colors(filename)
+    colors = {color: {shade: [p.red, p.green, p.blue] for (shade, p) in shades.items()}
+              for (color, shades) in player_cols.items()}
+    # written to a temporary file first so readers never see part of it
+    temp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path.write_text(json.dumps({'source': source, 'colors': colors}))
+        os.replace(temp_path, cache_path)
+    except OSError:
+        try:
+            temp_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+    return player_cols
+
+_player_cols = None
+_player_shades = None
+
+def get_player_colors() -> dict:
+    """The player colours of COLORS.INI by colour and shade number,
+    read the first time they are needed"""
+    global _player_cols
+    if _player_cols is None:
+        _player_cols = load_player_colors_cached()
+    return _player_cols
+
+def get_player_shades() -> dict:
+    """PlayerShadeIndexes of the player colours, built the first time they are needed"""
+    global _player_shades
+    if _player_shades is None:
+        _player_shades = index_player_colors(get_player_colors())
+    return _player_shades
+
+def player_color_lut(color: int):
+    """Packed 0xBBGGRR values for each shade of a player colour,
+    indexed by shade number. Missing shades are set to -1"""
+    lut = np.full(32, -1, dtype=np.int64)
+    for shade, p in get_player_colors()[color].items():
+        if shade < 32:
+            lut[shade] = p.red | (p.green << 8) | (p.blue << 16)
+    return lut
 
 def packPixel(value=(0,0,0), alpha=False):
     if len(value) < 3:
@@ -141,14 +692,7 @@ def packPixel(value=(0,0,0), alpha=False):
     return struct.pack("BBB", value[0], value[1], value[2])
 
 def decodePixel(half_word: int):
-    # Shift values move each colour channel to the right
-    # place value.
-    # Bitwise AND masks off the unwanted bits to leave
-    # only the desired channel.
-    blue = round((half_word & 0b11111) / 31 * 255)
-    green = round(((half_word >> 5) & 0b111111) / 63 * 255)
-    red = round(((half_word >> 11) & 0b11111) / 31 * 255)
-    return Pixel(red, green, blue)
+    return Pixel.from_int(half_word)
 
 class Line:
     def __init__(self, in_fh: io.BufferedReader, sprite=False):
@@ -160,38 +704,755 @@ class Line:
         self.offset = in_fh.tell()
         self.data_length = total_length - (self.offset - header_offset)
                 
+# One entry per line of a frame, holding the same values as a Line
+line_index_dtype = [('offset', '<u4'),
+                    ('transparent_pixels', '<i4'),
+                    ('pixel_length', '<i4'),
+                    ('data_length', '<i4')]
+
+def build_line_index(data, height: int, base_offset=0) -> np.recarray:
+    """Parse the line headers at the start of each line of a frame.
+    data starts at the first line header, which is at base_offset in the file"""
+    lap = stage_timer()
+    lines = []
+    header_widths = []
+    pos = 0
+    for _ in range(height):
+        header_offset = pos
+        (total_length, pos) = read_line_header(data, pos)
+        (transparent_pixels, pos) = read_line_header(data, pos)
+        (pixel_length, pos) = read_line_header(data, pos)
+        lines.append((base_offset + pos, transparent_pixels, pixel_length, total_length - (pos - header_offset)))
+        header_widths.append(pos - header_offset)
+        pos = header_offset + total_length
+    if stats is not None:
+        stats.add_line_headers(header_widths)
+    lap('line index')
+    return np.array(lines, dtype=line_index_dtype).view(np.recarray)
+
 class Frame:
-    def __init__(self, size, in_fh: io.BufferedReader):
+    """
+    A frame of a .TGR file. The table of lines is only read when
+    lines is first used, by calling read_data to get the frame data.
+    data_length is the length of the frame's FRAM chunk
+    """
+    def __init__(self, size, offset=0, read_data=None, data_length=0):
         self.size = size
-        self.lines = []
-        while len(self.lines) < self.size[1]:
-            newline = Line(in_fh, False)
-            #if newline.data_length == 0:
-            #    continue
-            self.lines.append(newline)
-            #if len(self.lines) >= self.size[1]:
-            #    break
-            in_fh.seek(newline.offset + newline.data_length)
+        self.offset = offset
+        self.read_data = read_data
+        self.data_length = data_length
+        self.line_index = None
+
+    @property
+    def lines(self) -> np.recarray:
+        if self.line_index is None:
+            data = self.read_data() if self.size[1] > 0 else b''
+            self.line_index = build_line_index(data, self.size[1], self.offset)
+        return self.line_index
+
+def layout_atlas(sizes: list, max_size=2048):
+    """Shelf pack frames of the given (width, height) sizes into pages
+    of at most max_size square, or the size of the largest frame if that
+    is bigger. Returns the (page, x, y) of each frame, with None for
+    empty frames, and the (width, height) of each page"""
+    limit_w = max([max_size] + [w for (w, h) in sizes])
+    limit_h = max([max_size] + [h for (w, h) in sizes])
+    placements = [None for _ in sizes]
+    page_sizes = []
+    (x, y, shelf_h) = (0, 0, 0)
+    # Tallest frames first so each shelf wastes as little height as possible
+    for index in sorted(range(len(sizes)), key=lambda i: sizes[i][1], reverse=True):
+        (w, h) = sizes[index]
+        if w == 0 or h == 0:
+            continue
+        if x + w > limit_w:
+            (x, y, shelf_h) = (0, y + shelf_h, 0)
+        if not page_sizes or y + h > limit_h:
+            (x, y, shelf_h) = (0, 0, 0)
+            page_sizes.append((0, 0))
+        placements[index] = (len(page_sizes) - 1, x, y)
+        (page_w, page_h) = page_sizes[-1]
+        page_sizes[-1] = (max(page_w, x + w), max(page_h, y + h))
+        x += w
+        shelf_h = max(shelf_h, h)
+    return (placements, page_sizes)
+
+# Kinds of pixel told apart by the encoder, in the order encodeLine checks for them
+PX_TRANSPARENT = 0
+PX_SHADOW = 1
+PX_PLAYER = 2
+PX_PLAYER_TRANSLUCENT = 3
+PX_TRANSLUCENT = 4
+PX_OPAQUE = 5
+
+@dataclass
+class FrameRuns:
+    """
+    The values encodeLine needs for each pixel of a frame, as one list
+    per row. same is the length of the run of identical pixels starting
+    at each pixel, and literal the length of the run of pixels that can
+    go in a 0b010 literal. colors and alphas are the quantised RGB565
+    and 5 bit alpha values, or palette indices for 8 bit frames, and
+    shades the player colour shade numbers. color_format is the struct
+    format colors are written with
+    """
+    kinds: list
+    same: list
+    literal: list
+    colors: list
+    alphas: list
+    shades: list
+    color_format: str = 'H'
+
+class Palette:
+    """
+    Up to 256 RGB565 colours for 8 bit files, with a table giving the
+    index of the nearest entry to every RGB565 colour
+    """
+    def __init__(self, words):
+        self.words = np.asarray(words, dtype=np.uint16)
+        if not 0 < len(self.words) <= 256:
+            raise ValueError(f"A palette needs 1 to 256 colours, not {len(self.words)}")
+        (rgb565_rgba, _, _, _, _) = get_colour_tables()
+        entries = rgb565_rgba[self.words, :3].astype(np.float64)
+        colours = rgb565_rgba[:, :3].astype(np.float64)
+        self.lut = np.empty(0x10000, dtype=np.uint8)
+        # Squared distance in 8 bit RGB, less the square of the colour, which is
+        # the same for every entry. The values are small enough to be exact
+        entry_squares = (entries ** 2).sum(axis=1)
+        for start in range(0, 0x10000, 0x1000):
+            distance = entry_squares - 2 * (colours[start:start + 0x1000] @ entries.T)
+            self.lut[start:start + 0x1000] = distance.argmin(axis=1)
+
+    def __len__(self):
+        return len(self.words)
+
+    def pack(self) -> bytes:
+        """The PALT chunk for the palette"""
+        data = struct.pack('<H', len(self.words)) + self.words.astype('<u2').tobytes()
+        return struct.pack('>4sI', b'PALT', len(data)) + data
+
+def distance_to_stop(stops: np.ndarray) -> np.ndarray:
+    """For each element of a 2D array, the distance to the first
+    True element at or after it in the same row. The end of the row
+    counts as a stop"""
+    width = stops.shape[1]
+    columns = np.arange(width)
+    first_stop = np.where(stops, columns, width)
+    first_stop = np.minimum.accumulate(first_stop[:, ::-1], axis=1)[:, ::-1]
+    return first_stop - columns
+
+def classify_pixels(pixels: np.ndarray, color=None):
+    """Sort the pixels of an HxWx4 RGBA frame into the PX_ kinds.
+    Returns each pixel as a little-endian int, its kind, and its
+    player colour shade number"""
+    keys = pixels.view('<u4')[..., 0]
+    alpha = pixels[..., 3]
+    transparent = keys == 0
+    shadows = keys == int.from_bytes(bytes(shadow.values()), 'little')
+
+    kinds = np.where(alpha < 255, PX_TRANSLUCENT, PX_OPAQUE).astype(np.uint8)
+    shades = np.zeros(keys.shape, dtype=np.int64)
+    others = ~(transparent | shadows)
+    if others.any():
+        (player, player_shade) = get_player_shades()[color].lookup(keys & 0xFFFFFF)
+        player &= others
+        kinds[player] = np.where(alpha[player] < 255, PX_PLAYER_TRANSLUCENT, PX_PLAYER)
+        shades[player] = player_shade[player]
+    kinds[shadows] = PX_SHADOW
+    kinds[transparent] = PX_TRANSPARENT
+    return (keys, kinds, shades)
+
+def color_histogram(pixels: np.ndarray, color=None) -> np.ndarray:
+    """Count the RGB565 colours of the opaque and translucent pixels of a
+    frame, leaving out the player colour, shadow and transparent pixels
+    that don't use the palette"""
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    (_, kinds, _) = classify_pixels(pixels, color)
+    in_palette = (kinds == PX_OPAQUE) | (kinds == PX_TRANSLUCENT)
+    return np.bincount(rgba_to_rgb565(pixels[in_palette]), minlength=0x10000)
+
+def median_cut_palette(histogram: np.ndarray, max_colors=256) -> Palette:
+    """Choose up to max_colors colours for a histogram of RGB565 colours.
+    If there are too many, the colours are split into boxes by median cut,
+    each time splitting the box with the most pixels at the weighted median
+    of its widest channel, and each box gives the pixel weighted mean of
+    its colours"""
+    words = np.flatnonzero(histogram)
+    if len(words) == 0:
+        return Palette([0])
+    if len(words) <= max_colors:
+        return Palette(words)
+    (rgb565_rgba, _, _, _, _) = get_colour_tables()
+    rgb = rgb565_rgba[words, :3].astype(np.int64)
+    counts = histogram[words].astype(np.int64)
+    boxes = [np.arange(len(words))]
+    # Pixels in each box, or -1 once a box is down to one colour
+    totals = [int(counts.sum())]
+    while len(boxes) < max_colors and max(totals) >= 0:
+        i = totals.index(max(totals))
+        box = boxes.pop(i)
+        totals.pop(i)
+        channel = np.ptp(rgb[box], axis=0).argmax()
+        box = box[np.argsort(rgb[box, channel], kind='stable')]
+        cumulative = np.cumsum(counts[box])
+        split = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+        split = min(max(split, 1), len(box) - 1)
+        for half in (box[:split], box[split:]):
+            boxes.append(half)
+            totals.append(int(counts[half].sum()) if len(half) > 1 else -1)
+    means = np.array([(rgb[box] * counts[box, None]).sum(axis=0) // counts[box].sum() for box in boxes])
+    # Boxes can round to the same colour, so they are merged
+    return Palette(np.unique(rgba_to_rgb565(means.astype(np.uint8))))
+
+def scan_frame_runs(pixels: np.ndarray, color=None, palette: Palette|None=None) -> FrameRuns:
+    """Classify the pixels of an HxWx4 RGBA frame and find the runs
+    encodeLine packs them into, for every row at once. With a palette,
+    colours are replaced by the index of the nearest palette colour"""
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    (keys, kinds, shades) = classify_pixels(pixels, color)
+    alpha = pixels[..., 3]
+    colors = rgba_to_rgb565(pixels)
+    color_format = 'H'
+    if palette is not None:
+        colors = palette.lut[colors]
+        color_format = 'B'
+        # Pixels whose colours share a palette entry are now the same. Keys
+        # above 32 bits can't be mistaken for transparent, shadow or player pixels
+        in_palette = (kinds == PX_OPAQUE) | (kinds == PX_TRANSLUCENT)
+        keys = np.where(in_palette, (1 << 32) | (alpha.astype(np.int64) << 8) | colors, keys)
+
+    # Whether each pixel differs from the one after it in the row
+    differs = np.ones(keys.shape, dtype=bool)
+    differs[:, :-1] = keys[:, :-1] != keys[:, 1:]
+    # Literals compare the last pixel of a row with the first of the next,
+    # and always take the last pixel of the frame
+    next_differs = differs.copy()
+    next_differs[:-1, -1] = keys[:-1, -1] != keys[1:, 0]
+    in_literal = (kinds == PX_OPAQUE) & next_differs
+
+    return FrameRuns(kinds.tolist(),
+                     (distance_to_stop(differs) + 1).tolist(),
+                     distance_to_stop(~in_literal).tolist(),
+                     colors.tolist(),
+                     get_colour_tables()[2][alpha].tolist(),
+                     shades.tolist(),
+                     color_format)
+
+def encode_line_header(frame_index, line_index, outbuf, ct_pixels, offset=0):
+    """Prefix a line's run data with its length, the offset to its first
+    non-padding pixel and its pixel count. Like read_line_header, each
+    takes one byte up to 0x7F, and otherwise two with the top bit set"""
+    assert offset <= 0x7FFF, f'f:{frame_index: >4} l:{line_index: >4} offset to first non-padding pixel exceeds 15 bit maximum'
+    assert ct_pixels <= 0x7FFF, f'f:{frame_index: >4} l:{line_index: >4} pixel count {ct_pixels} exceeds 15 bit maximum'
+
+    fields = b''.join(struct.pack('>H', v | 0x8000) if v > 0x7F else struct.pack('>B', v) for v in (offset, ct_pixels))
+    line_length = len(outbuf) + len(fields) + 1
+    if line_length > 0x7F:
+        assert line_length < 0x7FFF, f'f:{frame_index: >4} l:{line_index: >4} line length {line_length + 1} exceeds 15 bit maximum'
+        return struct.pack('>H', (line_length + 1) | 0x8000) + fields + outbuf
+    return struct.pack('>B', line_length) + fields + outbuf
+
+def encode_line(runs: FrameRuns, line_index: int, width: int, frame_index=0) -> bytes:
+    """Run-length encode one line of a frame from the scan of the frame
+    made by scan_frame_runs. frame_index is only used in messages"""
+    kinds = runs.kinds[line_index]
+    same = runs.same[line_index]
+    literal = runs.literal[line_index]
+    colors = runs.colors[line_index]
+    alphas = runs.alphas[line_index]
+    shades = runs.shades[line_index]
+    color_format = runs.color_format
+    pixel_ix = 0
+    offset = 0      # Offset from edge of frame to first non-padding pixel
+    ct_pixels = 0
+    padding_complete = False
+    outbuf = bytearray()
+
+    while pixel_ix < width:
+        kind = kinds[pixel_ix]
+        if kind == PX_TRANSPARENT:      # Encode transparent pixels
+            run_length = min(same[pixel_ix], 31)
+            # collect all leading padding
+            if not padding_complete:
+                offset += run_length
+                pixel_ix += run_length
+                continue
+            # Don't write trailing padding. same isn't capped at 31, so this
+            # sees whether the padding runs to the end of the line
+            if pixel_ix + same[pixel_ix] >= width:
+                break
+            outbuf.append((0b000 << 5) | run_length)
+            pixel_ix += run_length
+            ct_pixels += run_length
+            continue
+
+        padding_complete = True
+        if kind == PX_SHADOW:
+            run_length = min(same[pixel_ix], 31)
+            outbuf.append((0b101 << 5) | run_length)
+        elif kind == PX_PLAYER:
+            run_length = 1
+            outbuf.append((0b110 << 5) | (shades[pixel_ix] & 0b11111))
+        elif kind == PX_PLAYER_TRANSLUCENT:
+            # split color_index for packing
+            run_length = 1
+            color_index = shades[pixel_ix]
+            outbuf += struct.pack('<BB', (0b111 << 5) | (0b111 << 2) | (color_index & 0b11),
+                                  ((color_index & 0b11100) << 3) + alphas[pixel_ix])
+        elif kind == PX_TRANSLUCENT:
+            run_length = min(same[pixel_ix], 23)
+            if run_length == 1:
+                outbuf += struct.pack(f'<B{color_format}', (0b100 << 5) | alphas[pixel_ix], colors[pixel_ix])
+            else:
+                outbuf += struct.pack(f'<BB{color_format}', (0b011 << 5) | run_length, alphas[pixel_ix], colors[pixel_ix])
+        else:
+            run_length = min(same[pixel_ix], 31)
+            if run_length > 1:
+                outbuf += struct.pack(f'<B{color_format}', (0b001 << 5) | run_length, colors[pixel_ix])
+            else:
+                run_length = 1 if pixel_ix == width - 1 else min(literal[pixel_ix], 31)
+                outbuf.append((0b010 << 5) | run_length)
+                outbuf += struct.pack(f'<{run_length}{color_format}', *colors[pixel_ix:pixel_ix + run_length])
+        if verbose:
+            print(f'f:{frame_index: >4} l:{line_index: >4} c:{pixel_ix} kind:{kind} run:{run_length}')
+        pixel_ix += run_length
+        ct_pixels += run_length
+
+    return encode_line_header(frame_index, line_index, bytes(outbuf), ct_pixels, offset=offset)
+
+def encode_line_optimal(runs: FrameRuns, line_index: int, width: int, frame_index=0) -> bytes:
+    """Encode one line of a frame in as few bytes as extractLine can read,
+    rather than with encode_line's greedy choices. Working back from the
+    end of the line, best[i] is the fewest bytes that encode the pixels
+    from i on. Runs of identical pixels are always taken at their longest,
+    as a shorter run only leaves the same pixels for a later run to cover.
+    Literals may end anywhere, so take the cheapest of their up to 31 ends
+    from a sliding window minimum. Odd player colour shades can also be
+    packed two to a byte with 0b111 runs of up to 27 pixels"""
+    kinds = runs.kinds[line_index]
+    same = runs.same[line_index]
+    colors = runs.colors[line_index]
+    alphas = runs.alphas[line_index]
+    shades = runs.shades[line_index]
+    color_format = runs.color_format
+    px_bytes = struct.calcsize(color_format)
+
+    leading = 0
+    while leading < width and kinds[leading] == PX_TRANSPARENT:
+        leading += 1
+    end = width
+    while end > leading and kinds[end - 1] == PX_TRANSPARENT:
+        end -= 1
+    # Transparency past what the header's offset can hold is written as runs
+    offset = min(leading, 0x7FFF)
+    if end == leading:      # Nothing to draw
+        leading = end = offset
+
+    best = [0] * (end + 1)
+    choice = [None] * end
+    window = deque()    # Literal ends j, with best[j] + px_bytes*j falling towards the right
+    packed_end = end
+    for i in range(end - 1, offset - 1, -1):
+        kind = kinds[i]
+        run_length = min(same[i], end - i)
+        if kind == PX_TRANSPARENT:
+            options = [(1 + best[i + min(run_length, 31)], RUN_TRANSPARENT, min(run_length, 31))]
+        elif kind == PX_SHADOW:
+            options = [(1 + best[i + min(run_length, 31)], RUN_SHADOW, min(run_length, 31))]
+        elif kind == PX_TRANSLUCENT:
+            options = [(1 + px_bytes + best[i + 1], RUN_TRANSLUCENT, 1),
+                       (2 + px_bytes + best[i + min(run_length, 23)], RUN_TRANSLUCENT_REPEAT, min(run_length, 23))]
+        elif kind == PX_PLAYER_TRANSLUCENT:
+            options = [(2 + best[i + 1], RUN_PLAYER_TRANSLUCENT, 1)]
+        elif kind == PX_PLAYER:
+            options = [(1 + best[i + 1], RUN_PLAYER, 1)]
+            if shades[i] & 1 and shades[i] < 32:
+                for n in range(1, min(packed_end - i, 27) + 1):
+                    options.append((1 + (n + 1) // 2 + best[i + n], RUN_PLAYER_PACKED, n))
+        else:
+            options = [(1 + px_bytes + best[i + min(run_length, 31)], RUN_REPEAT, min(run_length, 31))]
+        if kind != PX_OPAQUE:
+            window.clear()
+        if kind != PX_PLAYER or not shades[i] & 1 or shades[i] >= 32:
+            packed_end = i
+
+        if kind == PX_OPAQUE:
+            # best[i] for a literal of n pixels is 1 + px_bytes*n + best[i+n]
+            j = i + 1
+            while window and best[window[0]] + px_bytes * window[0] >= best[j] + px_bytes * j:
+                window.popleft()
+            window.appendleft(j)
+            while window and window[-1] > i + 31:
+                window.pop()
+            if window:
+                j = window[-1]
+                options.append((1 + px_bytes * (j - i) + best[j], RUN_LITERAL, j - i))
+        (best[i], run_kind, n) = min(options, key=lambda option: option[0])
+        choice[i] = (run_kind, n)
+
+    outbuf = bytearray()
+    pixel_ix = offset
+    while pixel_ix < end:
+        (kind, n) = choice[pixel_ix]
+        if kind == RUN_TRANSPARENT:
+            outbuf.append((0b000 << 5) | n)
+        elif kind == RUN_SHADOW:
+            outbuf.append((0b101 << 5) | n)
+        elif kind == RUN_PLAYER:
+            outbuf.append((0b110 << 5) | (shades[pixel_ix] & 0b11111))
+        elif kind == RUN_PLAYER_PACKED:
+            # Two shades a byte, each stored as shade >> 1
+            outbuf.append((0b111 << 5) | n)
+            packed = [shade >> 1 for shade in shades[pixel_ix:pixel_ix + n]] + [0]
+            outbuf += bytes((packed[k] << 4) | packed[k + 1] for k in range(0, n, 2))
+        elif kind == RUN_PLAYER_TRANSLUCENT:
+            color_index = shades[pixel_ix]
+            outbuf += struct.pack('<BB', (0b111 << 5) | (0b111 << 2) | (color_index & 0b11),
+                                  ((color_index & 0b11100) << 3) + alphas[pixel_ix])
+        elif kind == RUN_TRANSLUCENT:
+            outbuf += struct.pack(f'<B{color_format}', (0b100 << 5) | alphas[pixel_ix], colors[pixel_ix])
+        elif kind == RUN_TRANSLUCENT_REPEAT:
+            outbuf += struct.pack(f'<BB{color_format}', (0b011 << 5) | n, alphas[pixel_ix], colors[pixel_ix])
+        elif kind == RUN_LITERAL:
+            outbuf.append((0b010 << 5) | n)
+            outbuf += struct.pack(f'<{n}{color_format}', *colors[pixel_ix:pixel_ix + n])
+        else:
+            outbuf += struct.pack(f'<B{color_format}', (0b001 << 5) | n, colors[pixel_ix])
+        pixel_ix += n
+
+    return encode_line_header(frame_index, line_index, bytes(outbuf), end - offset, offset=offset)
+
+def encode_frame(pixels: np.ndarray, color=None, frame_index=0, optimize=False, palette: Palette|None=None) -> bytes:
+    """Encode an HxWx4 RGBA frame as a FRAM chunk. This only depends on
+    its arguments, so frames can be encoded in any order or process.
+    optimize uses encode_line_optimal instead of the greedy encode_line.
+    With a palette the frame is encoded as 8 bit palette indices"""
+    lap = stage_timer()
+    runs = scan_frame_runs(pixels, color, palette)
+    lap('run scan')
+    (height, width) = pixels.shape[:2]
+    line_encoder = encode_line_optimal if optimize else encode_line
+    outbuf = b''.join(line_encoder(runs, line_index, width, frame_index) for line_index in range(height))
+    lap('encode')
+
+    # pad frame to 4-byte boundary
+    if len(outbuf) % 4 != 0:
+        outbuf += b'\x00' * (4 - (len(outbuf) % 4))
+
+    return struct.pack('>II', 0x4652414D, len(outbuf)) + outbuf
+
+def load_frame_arrays(path: str, mmap_mode='r'):
+    """Load frames saved by unpack --format npz or npy. Returns the header
+    arrays and a list holding an HxWx4 view of each frame's pixels, which
+    is empty for padding frames. Pixels saved to a .npy next to the
+    .npz are memory mapped with mmap_mode rather than read"""
+    path = Path(path)
+    with np.load(path) as npz:
+        header = dict(npz)
+    if 'pixels' in header:
+        pixels = header.pop('pixels')
+    else:
+        pixels = np.load(path.with_suffix('.npy'), mmap_mode=mmap_mode)
+    offsets = header['pixel_offsets']
+    frames = [pixels[offsets[i]:offsets[i+1]].reshape(h, w, 4) for i, (w, h) in enumerate(header['frame_sizes'])]
+    return (header, frames)
+
+class FrameCache:
+    """
+    A least recently used cache of decoded frames, limited to
+    max_bytes of frame data. A max_bytes of 0 disables caching
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, key):
+        return key in self.frames
+
+    def get(self, key):
+        frame = self.frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.frames.move_to_end(key)
+        return frame
+
+    def put(self, key, frame: np.ndarray):
+        if key in self.frames:
+            self.size_bytes -= self.frames.pop(key).nbytes
+        if frame.nbytes > self.max_bytes:
+            return
+        self.frames[key] = frame
+        self.size_bytes += frame.nbytes
+        while self.size_bytes > self.max_bytes:
+            (_, evicted) = self.frames.popitem(last=False)
+            self.size_bytes -= evicted.nbytes
+
+    def resize(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        while self.size_bytes > self.max_bytes:
+            (_, evicted) = self.frames.popitem(last=False)
+            self.size_bytes -= evicted.nbytes
+
+    def clear(self):
+        self.frames.clear()
+        self.size_bytes = 0
+
+    def stats(self):
+        return {"frames": len(self.frames),
+                "bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses}
+
+# Change this whenever encode_frame's output changes, so frames encoded
+# by an older version aren't taken from an EncodeCache
+encoder_version = 2
+
+def default_encode_cache_dir() -> Path:
+    return user_cache_dir() / 'frames'
+
+class EncodeCache:
+    """
+    A content addressed cache of encoded FRAM chunks on disk, so
+    frames that haven't changed don't need encoding again. Entries are
+    keyed by a hash of the frame pixels, crop box, crop mode, player
+    colour list and encoder version. Once the cache is larger than
+    max_bytes, evict() removes the least recently used entries
+    """
+    magic = b'TGRC'
+    entry_header = struct.Struct('<4s6i')
+
+    def __init__(self, directory: str|None=None, max_bytes=512 * 1024 * 1024):
+        self.directory = Path(directory) if directory else default_encode_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, pixels: np.ndarray, framesize: list, color=None, no_crop=False, optimize=False, palette: Palette|None=None) -> str:
+        h = hashlib.sha256()
+        h.update(f'{encoder_version}:{no_crop}:{optimize}:{[int(v) for v in framesize]}:{color}:{pixels.shape}:'.encode())
+        if color is not None:
+            h.update(player_color_lut(color).tobytes())
+        if palette is not None:
+            h.update(b'PALT' + palette.words.tobytes())
+        h.update(np.ascontiguousarray(pixels).data)
+        return h.hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / key[:2] / f'{key}.fram'
+
+    def get(self, key: str, framesize: list):
+        """The cached FRAM chunk for key, or None if there isn't one"""
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        if len(data) < self.entry_header.size or self.entry_header.unpack_from(data) != (self.magic, *framesize):
+            # Damaged, or a hash collision. Either way it can't be used
+            path.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data[self.entry_header.size:]
+
+    def put(self, key: str, framesize: list, frame_chunk: bytes):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so other processes never read a partial entry
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as fh:
+            fh.write(self.entry_header.pack(self.magic, *framesize))
+            fh.write(frame_chunk)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        max_bytes. Returns the number of entries removed"""
+        entries = []
+        for path in self.directory.glob('*/*.fram'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        size_bytes = sum(e[1] for e in entries)
+        removed = 0
+        for (_, size, path) in sorted(entries):
+            if size_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            size_bytes -= size
+            removed += 1
+        return removed
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "max_bytes": self.max_bytes}
+
+@dataclass
+class Event:
+    """
+    Something reported while reading or writing a file, passed to the
+    on_event handler of a tgrFile. kind is 'info' or 'warning' for
+    messages, 'frame_started' or 'frame_finished' as tgrtool decodes or
+    encodes each frame, or 'progress', with the frames done out of total
+    and the bytes of frame data read or written so far. nbytes of a
+    finished frame is the size of its frame data
+    """
+    kind: str
+    message: str = ''
+    frame_index: int|None = None
+    nbytes: int = 0
+    done: int = 0
+    total: int = 0
+
+def print_event(event: Event, progress=False):
+    """The default event handler, printing the message of each event.
+    Progress is only printed if progress is set"""
+    if event.message and (progress or event.kind != 'progress'):
+        print(event.message)
+
+def ignore_event(event: Event):
+    """The event handler for silent mode"""
+
+class RateLimited:
+    """
+    Wraps an event handler so progress events reach it at most once
+    every interval seconds, though the first and last of a run always do.
+    Other events are passed straight through
+    """
+    def __init__(self, handler, interval=1.0):
+        self.handler = handler
+        self.interval = interval
+        self.last_progress = None
+
+    def __call__(self, event: Event):
+        if event.kind == 'progress':
+            now = time.perf_counter()
+            if (self.last_progress is not None and event.done < event.total
+                    and now - self.last_progress < self.interval):
+                return
+            self.last_progress = now
+        self.handler(event)
+
+class SessionCache:
+    """
+    Loaded .TGR files kept between the commands of an interactive
+    session, each with the frames decoded from it, so unpacking a file
+    again in another player color or for a single frame doesn't parse
+    or decode it again. Files are keyed by path and reloaded when their
+    modification time or size changes. The least recently used files
+    are dropped once their decoded frames add up to more than max_bytes
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # resolved path -> ((mtime_ns, size), tgrFile)
+        self.files = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.files)
+
+    def open(self, filename: str, on_event=print_event) -> tgrFile:
+        """The loaded tgrFile for filename, passing its events to on_event.
+        Files aren't memory mapped, so they can be replaced while held"""
+        path = Path(filename).resolve()
+        try:
+            stat = path.stat()
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamp = None
+        entry = self.files.get(path)
+        if entry is not None and stamp is not None and entry[0] == stamp:
+            self.hits += 1
+            self.files.move_to_end(path)
+            imagefile = entry[1]
+            imagefile.on_event = on_event
+            return imagefile
+        self.discard(path)
+        self.misses += 1
+        imagefile = tgrFile(filename, False, cache_bytes=self.max_bytes, on_event=on_event)
+        imagefile.load()
+        if stamp is not None:
+            self.files[path] = (stamp, imagefile)
+        return imagefile
+
+    def discard(self, filename: str):
+        entry = self.files.pop(Path(filename).resolve(), None)
+        if entry is not None:
+            entry[1].close()
+
+    def size_bytes(self):
+        return sum(imagefile.frame_cache.size_bytes for (_, imagefile) in self.files.values())
+
+    def trim(self):
+        """Drop the least recently used files until the frames held fit
+        in max_bytes, keeping at least the most recent file"""
+        while len(self.files) > 1 and self.size_bytes() > self.max_bytes:
+            (_, (_, imagefile)) = self.files.popitem(last=False)
+            imagefile.close()
+
+    def clear(self):
+        for (_, imagefile) in self.files.values():
+            imagefile.close()
+        self.files.clear()
+
+    def stats(self):
+        return {"files": {str(path): imagefile.frame_cache.stats() for (path, (_, imagefile)) in self.files.items()},
+                "bytes": self.size_bytes(),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses}
 
 class tgrFile:
     """
     A class representing a .TGR game asset file,
-    which as a format is based on the IFF file structure
+    which as a format is based on the IFF file structure.
+    If mapped is set, a .TGR file is memory mapped once and
+    all chunks are parsed from the mapping. Call close()
+    or use the tgrFile as a context manager to release it.
+    Frames decoded with get_frame or get_frame_layers are
+    kept, without their player colour, in an LRU cache of up
+    to cache_bytes.
+    A directory holding an atlas.json sidecar is read as an
+    atlas written by write_atlas rather than as fram_ PNGs.
+    Messages and warnings are passed to on_event as Events,
+    which print_event prints and ignore_event drops.
     """
-    def __init__(self, filename: str, is_sprite=False):
+    def __init__(self, filename: str, is_sprite=False, mapped=False, cache_bytes=64 * 1024 * 1024, on_event=print_event):
+        self.on_event = on_event
         self.filename = Path(filename)
         self.read_from = self.filename.suffix.upper()
         #self.read_from = read_from
+        self.atlas = None
+        if self.read_from == '' and (self.filename / atlas_name).exists():
+            self.read_from = 'ATLAS'
         match self.read_from:
             case '.TGR':
-                self.iff = ifflib.iff_file(self.filename)
+                self.iff = ifflib.iff_file(self.filename, mapped)
+            case 'ATLAS':
+                self.read_atlas()
             case '.PNG':
                 self.imgs = []
                 self.imgs.append(Image.open(self.filename))
             case '':
                 filelist = list(self.filename.glob('*'))
                 self.imgs = [None for _ in range(len(filelist))]
-                print(f'Loading files from {self.filename.resolve()}')
+                self.emit('info', f'Loading files from {self.filename.resolve()}')
                 for f in filelist:
                     match f.suffix.upper():
                         case ".PNG":
@@ -200,20 +1461,20 @@ class tgrFile:
                             if m:
                                 fram_number = int(m.group(1))
                             else:
-                                print(f"Failed to find fram number from {f.stem}")
+                                self.emit('warning', f"Failed to find fram number from {f.stem}")
                                 exit(1)
-                            print('>', f, fram_number)
-                            # Maybe move opening the file into the load function
-                            self.imgs[fram_number] = Image.open(f)
+                            self.emit('info', f'> {f} {fram_number}')
+                            # Frames are only opened when they are loaded
+                            self.imgs[fram_number] = f
                         case '.INI':
-                            print(f'Skipping {f.stem + f.suffix}')
+                            self.emit('info', f'Skipping {f.stem + f.suffix}')
                             # Shortens list to prevent crashes when reading a NoneType object
                             del self.imgs[-1]
                         case _:
-                            print(f"Error: invalid file type {f.suffix}")
+                            self.emit('warning', f"Error: invalid file type {f.suffix}")
                             del self.imgs[-1]
             case _:
-                print(f"Error: invalid read type {self.read_from}")
+                self.emit('warning', f"Error: invalid read type {self.read_from}")
                 
         self.size: typing.Tuple[int, int] = (0,0)
         self.is_sprite = is_sprite
@@ -221,109 +1482,258 @@ class tgrFile:
         self.frameoffsets = []
         self.frames = []
         self.padding_frames = []
+        self.no_crop = False
+        # The palette frames are packed with when bits_per_px is 8
+        self.pack_palette = None
+        # The frame scan encodeLine made last
+        self.line_runs = None
+        self.frame_cache = FrameCache(cache_bytes)
+
+    def __enter__(self):
+        return self
 
-    def load(self, config_path: str|None=None, no_crop=False):
+    def __exit__(self, *exc):
+        self.close()
+
+    def emit(self, kind: str, message='', **fields):
+        """Pass an Event to the file's on_event handler"""
+        self.on_event(Event(kind, message, **fields))
+
+    def close(self):
+        if self.read_from == '.TGR':
+            self.iff.close()
+
+    def load(self, config_path: str|None=None, no_crop=False, lazy=False):
+        """Read the file's header, or the config of a PNG or atlas source.
+        PNG and atlas frames are loaded into img_data unless lazy is set"""
         match self.read_from:
             case '.TGR':
-                self.iff.load()
+                lap = stage_timer()
+                error = self.iff.load()
+                lap('iff parse')
+                if error is not None:
+                    self.emit('warning', error)
                 if self.iff.data.formtype != "TGAR":
-                    print(f"Error: invalid file type: {self.iff.data.formtype}")
+                    self.emit('warning', f"Error: invalid file type: {self.iff.data.formtype}")
                 self.read_header()
                 if self.indexed_colour:
                     self.load_palette()
                 self.get_frames()
-            case '.PNG':
+                lap('header')
+            case '.PNG' | 'ATLAS':
                 self.read_config(config_path)
+                self.no_crop = no_crop
                 self.img_data = [[] for _ in range(len(self.imgs))]
-                self.size = self.imgs[0].size
-                for index, img in enumerate(self.imgs):
-                    if index in self.padding_frames:
-                        self.framesizes.append([0, 0, 0xFFFF, 0xFFFF, 0xFFFF, 0xFFFF])
-                    else:
-                        if img.size != self.size:
-                            raise ValueError(f"Frame:{index} size:{img.size} doesn't match Frame:0 size:{self.size}")
-                        if not no_crop:
-                            # from https://stackoverflow.com/a/67677468
-                            img_array = np.array(img)
-                            # Find indices of non-transparent pixels (indices where alpha channel value is above zero).
-                            idx = np.where(img_array[:, :, 3] > 0)
-                            # Get minimum and maximum index in both axes (top left corner and bottom right corner)
-                            x0, y0, x1, y1 = idx[1].min(), idx[0].min(), idx[1].max(), idx[0].max()
-                            # Crop rectangle and convert to Image
-                            img = Image.fromarray(img_array[y0:y1+1, x0:x1+1, :])
-                            self.framesizes.append([x1-x0+1, y1-y0+1, x0, y0, x1, y1])  # +1 includes both endpoints
-                        else:
-                            self.framesizes.append([img.size[0], img.size[1], 0, 0, img.size[0]-1, img.size[1]-1])
-                        self.img_data[index] = img.getdata()
-                    
+                self.framesizes = [None for _ in range(len(self.imgs))]
+                if self.read_from == 'ATLAS':
+                    self.size = tuple(self.atlas['size'])
+                else:
+                    self.size = self.frame_size(0)
+                # Lazy sources leave the frames to be read by stream_frames as they are needed
+                if not lazy:
+                    for (index, pixels) in self.stream_frames():
+                        if pixels is not None:
+                            self.img_data[index] = pixels
+
+    def frame_size(self, index: int):
+        img = self.imgs[index]
+        if isinstance(img, Path):
+            # Only reads the PNG header
+            with Image.open(img) as f:
+                return f.size
+        return img.size
+
+    def frame_image(self, index: int) -> Image.Image:
+        """The RGBA image for a frame of a PNG or atlas source. The frames
+        of a directory are opened, read and closed each time"""
+        if self.read_from == 'ATLAS':
+            return self.atlas_frame_image(index)
+        img = self.imgs[index]
+        if isinstance(img, Path):
+            with Image.open(img) as f:
+                return f.convert('RGBA')
+        return img.convert('RGBA')
+
+    def load_frame(self, index: int):
+        """Read and crop one frame of a PNG or atlas source, filling in
+        its framesizes entry. Returns the frame's RGBA pixels, or None
+        for padding frames"""
+        if index in self.padding_frames:
+            self.framesizes[index] = [0, 0, 0xFFFF, 0xFFFF, 0xFFFF, 0xFFFF]
+            return None
+        lap = stage_timer()
+        if self.read_from == 'ATLAS':
+            # The frame rectangles are kept as they were unpacked, so no_crop has no effect
+            frame = self.atlas['frames'][index]
+            if frame is None:
+                raise ValueError(f"Frame:{index} is missing from {self.filename / atlas_name}")
+            (ulx, uly, lrx, lry) = frame['offset']
+            self.framesizes[index] = [lrx-ulx+1, lry-uly+1, ulx, uly, lrx, lry]
+            img_array = np.array(self.frame_image(index))
+            lap('image load')
+            return img_array
+
+        img_array = np.array(self.frame_image(index))
+        lap('image load')
+        (height, width) = img_array.shape[:2]
+        if (width, height) != self.size:
+            raise ValueError(f"Frame:{index} size:{(width, height)} doesn't match Frame:0 size:{self.size}")
+        if self.no_crop:
+            self.framesizes[index] = [width, height, 0, 0, width-1, height-1]
+            return img_array
+        # Crop to the rows and columns holding non-transparent pixels
+        visible = img_array[:, :, 3] > 0
+        cols = np.flatnonzero(visible.any(axis=0))
+        rows = np.flatnonzero(visible.any(axis=1))
+        if len(rows) == 0:
+            raise ValueError(f"Frame:{index} has no non-transparent pixels to crop to")
+        (x0, y0, x1, y1) = (int(cols[0]), int(rows[0]), int(cols[-1]), int(rows[-1]))
+        self.framesizes[index] = [x1-x0+1, y1-y0+1, x0, y0, x1, y1]  # +1 includes both endpoints
+        return np.ascontiguousarray(img_array[y0:y1+1, x0:x1+1, :])
+
+    def stream_frames(self, prefetch=2):
+        """Yield the index and pixels of each frame of a PNG or atlas
+        source in order, loading them with load_frame. Up to prefetch
+        frames are read ahead on a thread pool, so only a few frames
+        are in memory at once"""
+        with futures.ThreadPoolExecutor(max(prefetch, 1)) as loaders:
+            pending = deque()
+            for index in range(len(self.imgs)):
+                pending.append((index, loaders.submit(self.load_frame, index)))
+                if len(pending) > prefetch:
+                    (done_index, future) = pending.popleft()
+                    yield (done_index, future.result())
+            while pending:
+                (done_index, future) = pending.popleft()
+                yield (done_index, future.result())
 
     def read_header(self):
-        with open(self.filename, "rb") as in_fh:
-            in_fh.seek(self.iff.data.children[0].data_offset)
-            (self.version,
-             self.framecount,
-             self.bits_per_px) = struct.unpack("IHBx", in_fh.read(8))
-            (index_mode,
-             self.offset_flag) = struct.unpack("xBBx", in_fh.read(4))
-            self.size = struct.unpack("HH", in_fh.read(4))
-            self.hotspot = struct.unpack("HH", in_fh.read(4))
-            print(f'Image size: {self.size}')
-            
-            #print(self.offset_flag)
-            self.indexed_colour = index_mode & 0x7f == 0x1a
-            self.bounding_box = [*struct.unpack('HHHH',in_fh.read(8))]
-            in_fh.seek(12, 1)
-            #if self.indexed_colour:
-            #    in_fh.seek(12, 1)
-            for _ in range(self.framecount):
-                (ulx, uly, lrx, lry, offset) = struct.unpack("HHHHI", in_fh.read(12))
-                # Skip empty frames (offset will be zero)
-                if offset == 0:
-                    self.framesizes.append((0, 0, 0))
-                    self.frameoffsets.append(((0, 0), (0, 0)))
-                    print(f'Frame {_} is a padding frame. Leave frame as-is to avoid packing errors')
-                else:
-                    self.framesizes.append((1+lrx-ulx, 1+lry-uly, offset))
-                    self.frameoffsets.append(((ulx, uly), (lrx, lry)))
+        hedr = self.iff.chunk_data(self.iff.data.children[0])
+        (self.version,
+         self.framecount,
+         self.bits_per_px) = struct.unpack_from("IHBx", hedr, 0)
+        (index_mode,
+         self.offset_flag) = struct.unpack_from("xBBx", hedr, 8)
+        self.size = struct.unpack_from("HH", hedr, 12)
+        self.hotspot = struct.unpack_from("HH", hedr, 16)
+        self.emit('info', f'Image size: {self.size}')
+        
+        #print(self.offset_flag)
+        self.indexed_colour = index_mode & 0x7f == 0x1a
+        self.bounding_box = [*struct.unpack_from('HHHH', hedr, 20)]
+        # skip 12 bytes after the bounding box
+        pos = 40
+        for _ in range(self.framecount):
+            (ulx, uly, lrx, lry, offset) = struct.unpack_from("HHHHI", hedr, pos)
+            pos += 12
+            # Skip empty frames (offset will be zero)
+            if offset == 0:
+                self.framesizes.append((0, 0, 0))
+                self.frameoffsets.append(((0, 0), (0, 0)))
+                self.emit('info', f'Frame {_} is a padding frame. Leave frame as-is to avoid packing errors', frame_index=_)
+            else:
+                self.framesizes.append((1+lrx-ulx, 1+lry-uly, offset))
+                self.frameoffsets.append(((ulx, uly), (lrx, lry)))
+        
+        self.anim_count = struct.unpack_from('H', hedr, pos)[0]
+        pos += 2
+        self.animations = []
+        for _ in range(self.anim_count):
+            #(start_frame, frame_count, frame_rate) = struct.unpack('HHH', in_fh.read(6))
+            self.animations.append([*struct.unpack_from('HHH', hedr, pos)])
+            pos += 6
             
-            self.anim_count = struct.unpack('H',in_fh.read(2))[0]
-            self.animations = []
-            for _ in range(self.anim_count):
-                #(start_frame, frame_count, frame_rate) = struct.unpack('HHH', in_fh.read(6))
-                self.animations.append([*struct.unpack('HHH', in_fh.read(6))])
-                
         #print(len(self.framesizes))
 
     def load_palette(self):
-        palt = self.iff.data.children[1]
-        self.palette = []
-        with open(self.filename, "rb") as in_fh:
-            in_fh.seek(palt.data_offset)
-            (count,) = struct.unpack("<H", in_fh.read(2))
-            print(f'Colors in Palette: {count}')
-            for _ in range(count):
-                raw_pixel = in_fh.read(2)
-                if len(raw_pixel) < 2:
-                    raise ValueError("Not enough image data")
-                (pixel,) = struct.unpack("H", raw_pixel)
-                self.palette.append(Pixel.from_int(pixel))
+        palt = self.iff.chunk_data(self.iff.data.children[1])
+        (count,) = struct.unpack_from("<H", palt, 0)
+        self.emit('info', f'Colors in Palette: {count}')
+        raw_palette = palt[2:2 + count * 2]
+        if len(raw_palette) < count * 2:
+            raise ValueError("Not enough image data")
+        self.palette_words = struct.unpack(f'<{count}H', raw_palette)
+        self.palette = [Pixel.from_int(word) for word in self.palette_words]
+
+    @cached_property
+    def palette_rgba(self) -> np.ndarray:
+        """The palette as a (256, 4) RGBA array, built when first decoding.
+        It always has 256 entries so any index byte is valid"""
+        (rgb565_rgba, _, _, _, _) = get_colour_tables()
+        palette_rgba = np.zeros((256, 4), dtype=np.uint8)
+        palette_rgba[:min(len(self.palette_words), 256)] = rgb565_rgba[list(self.palette_words[:256])]
+        return palette_rgba
 
     def get_frames(self):
-        with open(self.filename, "rb") as in_fh:
-            for child in self.framesizes:
-                in_fh.seek(child[2])
-                newframe = Frame((child[0], child[1]), in_fh)
-                self.frames.append(newframe)
+        # The chunk lengths were read with the IFF structure, so the frame data isn't needed
+        lengths = {chunk.data_offset: chunk.length for chunk in self.iff.data.children if chunk.type == 'FRAM'}
+        for frame_index, child in enumerate(self.framesizes):
+            newframe = Frame((child[0], child[1]), child[2], partial(self.read_frame_data, frame_index), lengths.get(child[2], 0))
+            self.frames.append(newframe)
 
     def get_next_pixel(self, in_fh: io.BufferedReader):
         if self.indexed_colour:
             (pixel_ix,) = struct.unpack("B", in_fh.read(1))
-            return self.palette[pixel_ix]
+            # copy so setting alpha on the pixel doesn't change the palette
+            return self.palette[pixel_ix].copy()
         else:
             (raw_pixel,) = struct.unpack("H", in_fh.read(2))
             return Pixel.from_int(raw_pixel)
 
+    def read_frame_data(self, frame_index: int):
+        """Read the data of a FRAM chunk, starting at its first line.
+        This is a memoryview of the file if it is mapped"""
+        offset = self.framesizes[frame_index][2]
+        if self.iff.mapped:
+            buffer = self.iff.open()
+            (length,) = struct.unpack_from(">I", buffer, offset - 4)
+            return memoryview(buffer)[offset:offset + length]
+        with open(self.filename, "rb") as in_fh:
+            in_fh.seek(offset - 4)
+            (length,) = struct.unpack(">I", in_fh.read(4))
+            return in_fh.read(length)
+
+    def decodeFrame(self, frame_index=0, color=2, fx_error_fix=False) -> np.ndarray:
+        """Decode a whole frame into a (height, width, 4) RGBA array.
+        Gives the same pixels as calling extractLine for every line"""
+        return self.decodeFrameLayers(frame_index, fx_error_fix).with_color(player_color_lut(color))
+
+    def decodeFrameLayers(self, frame_index=0, fx_error_fix=False) -> FrameLayers:
+        """Decode a whole frame, leaving the player colour to be applied later"""
+        (width, height, offset) = self.framesizes[frame_index]
+        if offset == 0:
+            return FrameLayers(np.zeros((0, 0, 4), dtype=np.uint8), np.zeros((0, 0), dtype=np.uint8))
+        colour_table = None
+        if self.indexed_colour:
+            colour_table = self.palette_rgba.view('<u4').ravel()
+        return decode_frame_layers(self.read_frame_data(frame_index),
+                                   (width, height),
+                                   self.bits_per_px,
+                                   colour_table,
+                                   fx_error_fix)
+
+    def get_frame(self, frame_index: int, color=2, fx_error_fix=False) -> np.ndarray:
+        """Get a decoded frame as a (height, width, 4) RGBA array. The frame
+        is taken from the frame cache by get_frame_layers and coloured for
+        each call, so one cached frame serves every player colour"""
+        return self.get_frame_layers(frame_index, fx_error_fix).with_color(player_color_lut(color))
+
+    def get_frame_layers(self, frame_index: int, fx_error_fix=False) -> FrameLayers:
+        """Get a frame decoded without a player colour, so it can be coloured
+        for each player without decoding it again, using the frame cache if
+        it has already been decoded. The arrays are shared with the cache,
+        so they are read only"""
+        key = (frame_index, fx_error_fix)
+        layers = self.frame_cache.get(key)
+        if layers is None:
+            layers = self.decodeFrameLayers(frame_index, fx_error_fix)
+            layers.rgba.setflags(write=False)
+            layers.shades.setflags(write=False)
+            self.frame_cache.put(key, layers)
+        return layers
+
     def extractLine(self, fh: io.BufferedReader, frame_index=0, line_index=0, increment=0, color=2, fx_error_fix=False):
+        player_cols = get_player_colors()
         outbuf = []
         line_ix = 0
         pixel_ix = 0
@@ -335,6 +1745,8 @@ class tgrFile:
         pixel_ix += line.transparent_pixels
         
         while line_ix < line.data_length:# and pixel_ix < line.pixel_length:
+            run_start = line_ix
+            run_pixels = len(outbuf)
             run_header = fh.read(1)
             line_ix += 1
             (flag, run_length) = getRunData(run_header[0])
@@ -343,6 +1755,8 @@ class tgrFile:
                 if run_header[0] in (0x7F, 0xFD):
                     outbuf.append(Pixel(255, 0, 255, 0))
                     pixel_ix += 1
+                    if stats is not None:
+                        stats.add_run(run_header[0], 1, 1)
                     continue
                     
             match flag:
@@ -409,21 +1823,23 @@ class tgrFile:
                                 outbuf.append(player_cols[color][((b << 1) & 0b11111) | 0b1])
                                 pixel_ix += 1                    
                 case _:
-                    print(f"{line_index:3d},{pixel_ix:3d}: Unsupported flag {flag} in datapoint 0x{run_header[0]:02x} at offset 0x{fh.tell()-1:08x}")
+                    self.emit('warning', f"{line_index:3d},{pixel_ix:3d}: Unsupported flag {flag} in datapoint 0x{run_header[0]:02x} at offset 0x{fh.tell()-1:08x}", frame_index=frame_index)
+            if stats is not None:
+                stats.add_run(run_header[0], line_ix - run_start, len(outbuf) - run_pixels)
         if len(outbuf) < line.pixel_length:
-            print(f"Appending {line.pixel_length - len(outbuf)} pixels to line {line_index}")
+            self.emit('warning', f"Appending {line.pixel_length - len(outbuf)} pixels to line {line_index}", frame_index=frame_index)
             outbuf += [transparency for _ in range(line.pixel_length - len(outbuf))]
         return outbuf
     
     def read_config(self, config_path: str|None=None):
-        config = ConfigParser()
+        config = configparser.ConfigParser()
         if not config_path:
             config_path = f"{self.filename} / 'sprite.ini'"
         config.read(config_path)
         self.bits_per_px = int(config['BitDepth']['Depth'])
         self.hotspot = (int(config['HotSpot']['X']), int(config['HotSpot']['Y']))
         self.bounding_box = (int(config['BoundingBox']['XMin']), int(config['BoundingBox']['YMin']), int(config['BoundingBox']['XMax']), int(config['BoundingBox']['YMax']))
-        self.padding_frames = list(map(int, config['PaddingFrames']['FrameList'].split(',')))
+        self.padding_frames = [int(f) for f in config['PaddingFrames']['FrameList'].split(',') if f.strip()]
         
         self.animations = [(0, 0, 0, 0) for _ in range(6)]
         self.anim_count = 0
@@ -445,7 +1861,7 @@ class tgrFile:
     def write_config(self, config_path: str|None=None):
         if config_path == None:
             config_path = f'{self.filename.stem}/sprite.ini'
-        config = ConfigParser(dict_type=OrderedDict, allow_no_value=True)
+        config = configparser.ConfigParser(dict_type=OrderedDict, allow_no_value=True)
         config.optionxform = str
         config.add_section('Description')
         config.set('Description', (f'; This file contains metadata for the extracted sprite {self.filename.stem+self.filename.suffix}\n'+
@@ -454,8 +1870,7 @@ class tgrFile:
         config.add_section('BitDepth')
         config.set('BitDepth', ('; BitDepth is the number of bits used to encode each pixel color.\n'+
                                 '; This will be 16 if the sprite uses direct color and 8 if it uses a color palette'))
-        # hardcoded to 16 because repacking with a palette is not currently supported
-        config.set('BitDepth', 'Depth', '16')
+        config.set('BitDepth', 'Depth', str(self.bits_per_px))
         
         config.add_section('HotSpot')
         config.set('HotSpot', '; HotSpot is the position the sprite is displayed at in-game relative to the game object')
@@ -496,257 +1911,102 @@ class tgrFile:
         with open(config_path, 'w') as c_fh:
             config.write(c_fh)
 
-    def look_ahead(self, p: Pixel, frame_index, line_index, pixel_ix, matching=True, color=None, translucent=False):
-        collected = 0
-        if matching:
-            if verbose and frame_index == 0:
-                print(f'frame_index:{frame_index} (max:{len(self.img_data)}) pixel:{pixel_ix + collected + 1} (max:{self.framesizes[frame_index][0]}) total:{line_index*self.framesizes[frame_index][0] + pixel_ix + collected + 1} (max:{len(self.img_data[frame_index])}) size_data:{self.framesizes[frame_index]}')
-            while (pixel_ix + collected + 1 < self.framesizes[frame_index][0]):
-                next_pixel = Pixel(*self.img_data[frame_index][line_index*self.framesizes[frame_index][0] + pixel_ix + collected + 1])
-                if p != next_pixel:
-                    break
-                if color and max_alpha(next_pixel) in player_cols[color].values():
-                    break
-                collected += 1
-                if translucent and collected == 22:
-                    break
-                if collected == 30:
-                    break
-            return collected
-        else:
-            if pixel_ix == self.framesizes[frame_index][0] - 1:    # If last pixel in row:
-                return 1                        # Return 1 pixel, don't compare
-            while True:
-                if pixel_ix + collected >= self.framesizes[frame_index][0]:
-                    break
-                this_pixel = Pixel(*self.img_data[frame_index][line_index*self.framesizes[frame_index][0] + pixel_ix + collected])
-                next_pixel = Pixel(*self.img_data[frame_index][line_index*self.framesizes[frame_index][0] + pixel_ix + collected + 1])
-                if this_pixel == next_pixel or this_pixel.alpha != 255:
-                    break
-                if color and max_alpha(this_pixel) in player_cols[color].values():
-                    break
-                if verbose and frame_index == 0:
-                    print(f"\tLook_Ahead: pixel {this_pixel} at c:{pixel_ix + collected} doesn't match pixel {next_pixel} at c:{pixel_ix + collected + 1}")
-                collected += 1
-                if collected == 31:
-                    break
-            if verbose:
-                print(f'      Look_Ahead: collected {collected} individual pixels')
-            return collected
-    
+    def read_atlas(self):
+        """Read the sidecar of an atlas directory. Frames are sliced out of
+        the pages by frame_image as they are loaded"""
+        self.emit('info', f'Loading atlas from {self.filename.resolve()}')
+        with open(self.filename / atlas_name) as a_fh:
+            self.atlas = json.load(a_fh)
+        self.imgs = list(self.atlas['frames'])
+        # The last page decoded, as (page number, image)
+        self.atlas_page = (None, None)
+        self.atlas_lock = threading.Lock()
+
+    def atlas_frame_image(self, index: int) -> Image.Image:
+        """Slice a frame out of its atlas page. Frames are laid out in
+        order, so only the last page decoded is kept"""
+        frame = self.imgs[index]
+        if frame is None:
+            return Image.new('RGBA', (1, 1))
+        # stream_frames loads frames from a thread pool
+        with self.atlas_lock:
+            (page_index, page) = self.atlas_page
+            if page_index != frame['page']:
+                with Image.open(self.filename / self.atlas['pages'][frame['page']]) as f:
+                    page = f.convert('RGBA')
+                self.atlas_page = (frame['page'], page)
+        (x, y, w, h) = frame['rect']
+        return page.crop((x, y, x + w, y + h))
+
+    def write_atlas(self, atlas_path: str, placements: list, pages: list, color: int|None=None):
+        """Write the sidecar for an atlas. placements holds the (page, x, y)
+        of each frame in the page files, or None if it wasn't unpacked.
+        Together with sprite.ini this is all pack needs to rebuild the file"""
+        frames = []
+        for frame_index, placement in enumerate(placements):
+            if placement is None:
+                frames.append(None)
+                continue
+            (page, x, y) = placement
+            ((ulx, uly), (lrx, lry)) = self.frameoffsets[frame_index]
+            frames.append({'page': page,
+                           'rect': [x, y, lrx - ulx + 1, lry - uly + 1],
+                           'offset': [ulx, uly, lrx, lry]})
+        atlas = {'source': self.filename.name,
+                 'size': list(self.size),
+                 'color': color,
+                 'pages': pages,
+                 'frames': frames,
+                 'padding_frames': self.padding_frames,
+                 'animations': [list(a) for a in self.animations]}
+        with open(atlas_path, 'w') as a_fh:
+            json.dump(atlas, a_fh, indent=1)
+
+    def frame_array_header(self, sizes: list) -> dict:
+        """Arrays describing frames of the given (width, height) sizes
+        stored one after another in a single array of RGBA pixels.
+        Frame i is pixels[pixel_offsets[i]:pixel_offsets[i+1]]"""
+        pixel_counts = [w * h for (w, h) in sizes]
+        return {'size': np.array(self.size, dtype=np.int64),
+                'frame_sizes': np.array(sizes, dtype=np.int64).reshape(-1, 2),
+                'frameoffsets': np.array(self.frameoffsets, dtype=np.int64).reshape(-1, 4),
+                'pixel_offsets': np.concatenate(([0], np.cumsum(pixel_counts, dtype=np.int64))),
+                'padding_frames': np.array(self.padding_frames, dtype=np.int64),
+                'hotspot': np.array(self.hotspot, dtype=np.int64),
+                'bounding_box': np.array(self.bounding_box, dtype=np.int64),
+                'animations': np.array(self.animations, dtype=np.int64).reshape(-1, 3)}
+
     def encodeLineHeader(self, frame_index, line_index, outbuf, ct_pixels, offset=0):
-        #print(outbuf)
-        line_length = len(outbuf)
-        header_length = 3
-        
-        assert line_length <= 0x7FFA, f'f:{frame_index: >4} l:{line_index: >4} line length {line_length} exceeds 15 bit maximum'
-        assert offset <= 0xFF, f'f:{frame_index: >4} l:{line_index: >4} offset to first non-padding pixel exceeds 8 bit maximum'
-        assert ct_pixels <= 0x7FFF, f'f:{frame_index: >4} l:{line_index: >4} pixel count {ct_pixels} exceeds 15 bit maximum'
-        
-        if ct_pixels > 0x7F:
-            ct_pixels = ct_pixels | 0x8000
-            pfc = 'H'
-            header_length += 1
-        else:
-            pfc = 'B'
-        
-        if line_length + header_length > 0x7F:
-            line_length = line_length | 0x8000
-            lfc = 'H'
-            header_length += 1
-        else:
-            lfc = 'B'
-        
-        return struct.pack('>'+lfc+'B'+pfc, line_length+header_length, offset, ct_pixels) + outbuf
-        
-        
-    def encodeLine(self, frame_index=0, line_index=0, color=None):
-        if verbose:
-            print(f"image size:{self.size}")
-        pixel_ix = 0
-        offset = 0      # Offset from edge of frame to first non-padding pixel
-        ct_pixels = 0
-        padding_complete = False
-        outbuf = b''
-        
-        while pixel_ix < self.framesizes[frame_index][0]:
-            if frame_index == 0:
-                if verbose:
-                    print(f'TOP OF LOOP: pixel_ix:{pixel_ix}')
-            
-            p = Pixel(*self.img_data[frame_index][line_index*self.framesizes[frame_index][0] + pixel_ix])
-            if verbose:
-                print(f'reading p:{p} at l:{line_index} c:{pixel_ix}')
-                
-            # Allows for offset to collect more than 31 pixels, set true once first non-padding pixel is reached
-            if padding_complete == False and p != transparency:
-                padding_complete = True
-                
-            if p == transparency:        # Encode transparent pixels
-                if verbose:
-                    print(f'  chose flag 0b000')
-                run_length = self.look_ahead(p, frame_index, line_index, pixel_ix) + 1
-                # collect all leading padding
-                if not padding_complete:
-                    offset += run_length
-                    pixel_ix += run_length
-                # Don't write trailing padding
-                elif pixel_ix + run_length >= self.framesizes[frame_index][0]:
-                    break
-                else:
-                    if run_length == 31:
-                        print(f'31 transparent pixels found, begining scan-ahead at l:{line_index} p:{pixel_ix}')
-                        collected = run_length
-                        while pixel_ix + collected < self.framesizes[frame_index][0] and (ct := self.look_ahead(p, frame_index, line_index, pixel_ix + collected) + 1) == 31:
-                            print(f'   read {ct} more, total is {collected}')
-                            collected += ct
-                        collected += ct  # ct won't have been added the final time
-                        if pixel_ix + collected >= self.framesizes[frame_index][0]:
-                            break
-                    
-                    flag = 0b000 << 5
-                    header = flag + (run_length & 0b11111)
-                    outbuf += struct.pack('<B', header)
-                    pixel_ix += run_length
-                    ct_pixels += run_length
-                    if verbose:
-                        print(f'  packing header {header:02X}')
-            
-                if verbose:
-                    print(f'  advanced to c:{pixel_ix}')
-                
-            elif p == shadow:
-                ct_shadow = self.look_ahead(p, frame_index, line_index, pixel_ix) + 1
-                flag = 0b101 << 5
-                header = flag + (ct_shadow & 0b11111)
-                outbuf += struct.pack('<B', header)
-                pixel_ix += ct_shadow
-                ct_pixels += ct_shadow
-            
-            # Set alpha to 255 for compare so translucent PP will still match
-            elif max_alpha(p) in player_cols[color].values():
-                # encode translucent PP
-                if p.alpha < 255:
-                    flag = 0b111 << 5
-                    fixed_bits = 0b111 << 2
-                    color_index = list(player_cols[color].keys())[list(player_cols[color].values()).index(max_alpha(p))]
-                    # split color_index for packing
-                    ci_l = (color_index & 0b11)
-                    ci_h = (color_index & 0b11100) << 3
-                    a = p.to_int()[3] & 0b11111
-                    header = flag + fixed_bits + ci_l
-                    body = ci_h + a
-                    outbuf += struct.pack('<BB', header, body)
-                    print(f"  packing header {header:02X} and body {body:02X}")
-                    pixel_ix += 1
-                    ct_pixels += 1
-                    
-                    # encode opaque PP
-                else:
-                    if verbose:
-                        if frame_index == 0:
-                            print(f'matched pixel {p} in color list {color}')
-                        printf('  chose flag 0b110')
-                    flag = 0b110 << 5
-                    color_index = list(player_cols[color].keys())[list(player_cols[color].values()).index(p)]
-                    header = flag + (color_index & 0b11111)
-                    outbuf += struct.pack('B', header)
-                    pixel_ix += 1
-                    ct_pixels += 1
-                    if verbose and frame_index == 0:
-                        print(f'  packed {header:02X}, flag {flag}, index {color_index}')
-                
-            elif p.alpha < 255:     #Encode translucent pixels                    
-                run_length = self.look_ahead(p, frame_index, line_index, pixel_ix, translucent=True) + 1
-                (r,g,b,a) = p.to_int()
-                if run_length == 1:
-                    if verbose:
-                        print(f'  chose flag 0b100')
-                    flag = 0b100 << 5
-                    header = flag + (a & 0b11111)
-                    body = (r << 11) + (g << 5) + b
-                    if verbose:
-                        print(f"  packing header {header:02X} and body {body:04X}")
-                    outbuf += struct.pack('<BH', header, body)
-                else:
-                    if verbose:
-                        print(f'  chose flag 0b011')
-                    flag = 0b011 << 5
-                    header = flag + (run_length & 0b11111)
-                    body = (r << 11) + (g << 5) + b
-                    outbuf += struct.pack('<BBH', header, a, body)
-                    if verbose:
-                        print(f'  packing header {header:02X} alpha {a:02X} and body {body:04X}')
-                pixel_ix += run_length
-                ct_pixels += run_length
-                if verbose:
-                    print(f'  advanced to c:{pixel_ix}')
-                    
-            else:                   # Encode opaque pixels
-                matching = self.look_ahead(p, frame_index, line_index, pixel_ix, color=color)
-                if matching:
-                    if verbose:
-                        print(f'  chose flag 0b001')
-                    flag = 0b001 << 5
-                    run_length = matching + 1
-                    header = flag + (run_length & 0b11111)
-                    (r,g,b,a) = p.to_int()
-                    body = (r << 11) + (g << 5) + b
-                    outbuf += struct.pack('<BH', header, body)
-                    pixel_ix += run_length
-                    ct_pixels += run_length
-                    if verbose:
-                        print(f'  packing header {header:02X} and body {body:04X}\n  advanced to c:{pixel_ix}')
-                
-                else:
-                    non_matching = self.look_ahead(p, frame_index, line_index, pixel_ix, matching=False, color=color)
-                    if non_matching:
-                        if verbose:
-                            print(f'  chose flag 0b010')
-                        run_length = non_matching
-                        if verbose:
-                            print(f'  found {run_length} unique pixels')
-                        flag = 0b010 << 5
-                        header = flag + (run_length & 0b11111)
-                        outbuf += struct.pack('<B', header)
-                        if verbose:
-                            print(f'  packing header {header:02X}')
-                        for i in range(0,run_length):
-                            cur_pix = Pixel(*self.img_data[frame_index][line_index*self.framesizes[frame_index][0] + pixel_ix + i])
-                            (r,g,b,a) = cur_pix.to_int()
-                            if verbose:
-                                print(f'    p:{cur_pix} r:{r} g:{g} b:{b} a:{a}')
-                            body = (r << 11) + (g << 5) + b
-                            outbuf += struct.pack('<H', body)
-                            if verbose:
-                                print(f'    packing body:{body:04X}')
-                        pixel_ix += run_length
-                        ct_pixels += run_length
-                    
-                    else:
-                        print(f'f:{frame_index: >4} l:{line_index: >4} p:{pixel_ix} : could not pack {p}, defaulting to 0x0000')
-                        header = 0b01000001
-                        pixel = 0x0000
-                        outbuf += struct.pack('<BH', header, body)
-                        pixel_ix += 1
-                        ct_pixels += 1
-                        
-                if verbose:
-                        print(f'  advanced to c:{pixel_ix}')
-        
-        return self.encodeLineHeader(frame_index, line_index, outbuf, ct_pixels, offset=offset)    
-        
-    
-    def encodeFrame(self, frame_index=0, color=None):
-        outbuf = b''
-        for line_index in range(0,self.framesizes[frame_index][1]):
-            outbuf += self.encodeLine(frame_index=frame_index, line_index=line_index, color=color)
-        
-        # pad frame to 4-byte boundary
-        if len(outbuf) % 4 != 0:
-            outbuf += b'\x00' * (4 - (len(outbuf) % 4))
-        
-        return struct.pack('>II', 0x4652414D, len(outbuf)) + outbuf
+        return encode_line_header(frame_index, line_index, outbuf, ct_pixels, offset)
+
+    def encodeLine(self, frame_index=0, line_index=0, color=None, runs=None):
+        """Run-length encode one line of a frame. Kept for compatibility,
+        as pack encodes whole frames with encode_frame. runs is the scan
+        of the frame from scan_frame_runs. If it isn't given the scan is
+        made here and kept for the following lines of the same frame"""
+        if runs is None:
+            pixels = self.img_data[frame_index]
+            # The pixels and palette are kept with the scan, so their ids aren't reused
+            key = (frame_index, color, id(pixels), id(self.pack_palette))
+            if self.line_runs is None or self.line_runs[0] != key:
+                self.line_runs = (key, pixels, self.pack_palette, scan_frame_runs(pixels, color, self.pack_palette))
+            runs = self.line_runs[3]
+        line = encode_line(runs, line_index, self.framesizes[frame_index][0], frame_index)
+        if stats is not None:
+            stats.add_frame_data(line, 1, 8 if runs.color_format == 'B' else 16)
+        return line
+
+    def encodeFrame(self, frame_index=0, color=None, optimize=False):
+        return encode_frame(self.img_data[frame_index], color, frame_index, optimize, self.pack_palette)
+
+    def color_histogram(self, color=None) -> np.ndarray:
+        """Count the RGB565 colours used by the frames of a PNG or atlas
+        source that is loaded, or lazily loaded, for a palette"""
+        histogram = np.zeros(0x10000, dtype=np.int64)
+        for (_, pixels) in self.stream_frames():
+            if pixels is not None:
+                histogram += color_histogram(pixels, color)
+        return histogram
     
     def calcHotSpot(self):
         if self.hotspot != (0,0):
@@ -760,12 +2020,22 @@ class tgrFile:
         return (x,y)
     
     def calcPaletteOffset(self):
-        # TODO
-        return 0
+        """The file offset of the palette's colour count, just past the
+        PALT chunk header, which follows the HEDR chunk"""
+        if self.bits_per_px != 8:
+            return 0
+        return 12 + 8 + 40 + len(self.img_data)*12 + len(self.packAnimations()) + 8
+
+    def packPalette(self):
+        if self.bits_per_px != 8:
+            return b''
+        if self.pack_palette is None:
+            raise ValueError("8 bit files need a palette to be packed with")
+        return self.pack_palette.pack()
     
     def packFrameSizes(self, anim_buf: bytes):
-        offset_to_fram = 12 + 8 + 40 + len(self.img_data)*12 + len(anim_buf) + 8
-        # FORM + HEDR header + HEDR body + expected frame sizes + animations + FRAM header
+        offset_to_fram = 12 + 8 + 40 + len(self.img_data)*12 + len(anim_buf) + len(self.packPalette()) + 8
+        # FORM + HEDR header + HEDR body + expected frame sizes + animations + PALT chunk + FRAM header
         outbuf = b''
         for s, o in zip(self.framesizes, self.frameoffsets):
             # make sure offset stays 0 for padding frames
@@ -798,7 +2068,8 @@ class tgrFile:
         version = 0x04
         frame_count = len(self.img_data)
         if self.bits_per_px == 8:
-            index_mode = 0x001A
+            # read_header takes the index mode from the high byte
+            index_mode = 0x1A00
         else:
             index_mode = 0
         offset_flag = 0
@@ -861,27 +2132,29 @@ class tgrFile:
     
     # Resizes input image to portrait dimensions
     def resize(self, portrait_size):
+        if isinstance(self.imgs[0], Path):
+            self.imgs[0] = Image.open(self.imgs[0])
         inW, inH = self.imgs[0].size
         if portrait_size == "small":     # rescale to 66 X 72 (internal size of portrait frame)
             outW, outH, frame_width = 66, 72, 4
         elif portrait_size == "large":   # rescale to 220 X 220 (internal size of large frame)
             outW, outH, frame_width = 220, 220, 5
         else:
-            print(f'{out_size} is not a valid size')
+            self.emit('warning', f'{portrait_size} is not a valid size')
             sys.exit()
         
         if inH < (inW * outH / outW):   # if height less than width * inverse scaling factor
             crW = int(inH*outW/outH)    # set width equal to height, then scale to maintain AR
             crop = int((inW - crW) / 2)
             box = (crop ,0 ,inW - crop , inH)
-            print(f'Cropping width from {inW} to {crW} using bounding box {box}')
+            self.emit('info', f'Cropping width from {inW} to {crW} using bounding box {box}')
         else:
             crH = int(inW*outH/outW)
             crop = int((inH - crH) / 2)
             box = (0 ,crop ,inW, inH - crop)
-            print(f'Cropping height from {inH} to {crH} using bounding box {box}')
+            self.emit('info', f'Cropping height from {inH} to {crH} using bounding box {box}')
         
-        print(f'Resizing to {outW}x{outH}')
+        self.emit('info', f'Resizing to {outW}x{outH}')
         cropped_im = self.imgs[0].crop(box).resize((outW, outH))
         
         padding_im = Image.new('RGBA', (outW+2*frame_width,outH+2*frame_width))
@@ -915,8 +2188,61 @@ class tgrFile:
             hsv_im_data[:,:,2][full_mask.astype('?')] = hsv_im_data[:,:,2][full_mask.astype('?')].clip(min=6)
             self.imgs[0] = Image.fromarray(hsv_im_data.astype('uint8'),mode='HSV').convert('RGBA')
         return
-    
 
-        
+class TgrWriter:
+    """
+    Writes a .TGR file to a seekable binary sink one FRAM chunk at a time.
+    Space for the FORM and HEDR chunk headers is reserved up front, and
+    they are written once close() is called and all frame offsets are
+    known. The header values come from tgr, which should be loaded, and
+    8 bit files get tgr's pack_palette as their PALT chunk
+    """
+    def __init__(self, sink: typing.BinaryIO, tgr: tgrFile):
+        self.sink = sink
+        self.tgr = tgr
+        self.frame_count = len(tgr.img_data)
+        self.frameoffsets = []
+        self.form_start = sink.tell()
+        sink.write(struct.pack('>4sI4s', b'FORM', 0, b'TGAR'))
+        self.hedr_start = sink.tell()
+        # HEDR chunk header + HEDR body + frame table + animations
+        sink.write(b'\x00' * (8 + 40 + self.frame_count*12 + len(tgr.packAnimations())))
+        self.hedr_end = sink.tell()
+        sink.write(tgr.packPalette())
+        self.fram_start = sink.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Leave a failed file as it is rather than writing a header for it
+        if exc_type is None:
+            self.close()
+
+    def write_frame(self, frame_chunk: bytes):
+        """Write a FRAM chunk, as returned by tgrFile.encodeFrame"""
+        self.frameoffsets.append(self.sink.tell() - self.fram_start)
+        self.sink.write(frame_chunk)
+
+    def write_padding_frame(self):
+        self.frameoffsets.append(0)
+        self.sink.write(struct.pack('4sI', b'FRAM', 0))
+
+    def close(self):
+        """Write the HEDR and FORM chunk headers, returning the file length"""
+        if len(self.frameoffsets) != self.frame_count:
+            raise ValueError(f"Wrote {len(self.frameoffsets)} frames, expected {self.frame_count}")
+        end = self.sink.tell()
+        self.tgr.frameoffsets = self.frameoffsets
+        hedr = self.tgr.encodeHeader(b'')
+        assert len(hedr) == self.hedr_end - self.hedr_start
+        self.sink.seek(self.hedr_start)
+        self.sink.write(hedr)
+        # The FORM length doesn't include the form type, as in encodeForm
+        self.sink.seek(self.form_start)
+        self.sink.write(struct.pack('>4sI', b'FORM', end - self.form_start - 12))
+        self.sink.seek(end)
+        return end - self.form_start
+
 if __name__ == "__main__":
     pass
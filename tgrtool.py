@@ -1,37 +1,238 @@
 #!/usr/bin/python
 
+from __future__ import annotations
+
 import argparse
+import contextlib
+import json
+import os
+import sys
+import time
 import tgrlib
-import struct
+from collections import deque
+from functools import partial
 from pathlib import Path
-from PIL import Image
+
+# Imported when a command first needs them, so --help and info start quickly
+np = tgrlib.lazy_import('numpy')
+Image = tgrlib.lazy_import('PIL.Image')
+futures = tgrlib.lazy_import('concurrent.futures')
+
+# Handler for the events of the command being run. See run
+events = tgrlib.print_event
+
+def report(kind: str, message='', **fields):
+    """Pass an Event that isn't about one file to the command's handler"""
+    events(tgrlib.Event(kind, message, **fields))
+
+# Files and frames kept between the commands of the interactive tool,
+# a tgrlib.SessionCache. None when running a single command
+session = None
+
+def open_tgr(image_path: str, on_event=None) -> tgrlib.tgrFile:
+    """Load a .TGR file to decode its frames, or take it from the session
+    cache of the interactive tool"""
+    on_event = events if on_event is None else on_event
+    if session is not None:
+        return session.open(image_path, on_event)
+    # each frame is only decoded once, so there's no need to cache them
+    imagefile = tgrlib.tgrFile(image_path, False, mapped=True, cache_bytes=0, on_event=on_event)
+    imagefile.load()
+    return imagefile
+
+class FrameProgress:
+    """Reports the frames of a command as they finish, with the number
+    done and the bytes of frame data read or written so far, as events
+    of imagefile"""
+    def __init__(self, imagefile: tgrlib.tgrFile, total: int):
+        self.imagefile = imagefile
+        self.total = total
+        self.done = 0
+        self.nbytes = 0
+
+    def started(self, frame_index: int, message=''):
+        self.imagefile.emit('frame_started', message, frame_index=frame_index)
+
+    def finished(self, frame_index: int, nbytes: int, message=''):
+        self.done += 1
+        self.nbytes += nbytes
+        self.imagefile.emit('frame_finished', message, frame_index=frame_index, nbytes=nbytes)
+        self.imagefile.emit('progress', f'{self.done}/{self.total} frames, {self.nbytes} bytes',
+                            done=self.done, total=self.total, nbytes=self.nbytes)
+
+def frame_data_size(imagefile: tgrlib.tgrFile, frame_index: int):
+    return imagefile.frames[frame_index].data_length
+
+def frame_images(imagefile: tgrlib.tgrFile, frame_index: int, output_dirs: dict, no_align_frames=False, fx_error_fix=False):
+    """Decode a frame, returning an image and the path to save it to
+    for each player color in output_dirs"""
+    pixel_format = "RGBA"
+    images = []
+    layers = imagefile.get_frame_layers(frame_index, fx_error_fix=fx_error_fix)
+    for color, output_dir in output_dirs.items():
+        imagedata = layers.with_color(tgrlib.player_color_lut(color))
+        if no_align_frames:
+            image = Image.fromarray(imagedata)
+        else:
+            image = Image.new(pixel_format, imagefile.size)
+            fram_img = Image.fromarray(imagedata)
+            offset = imagefile.frameoffsets[frame_index][0]
+            image.paste(fram_img, offset)
+        images.append((image, f"{output_dir}/fram_{frame_index:04d}.png"))
+    return images
+
+def save_image(image: Image.Image, path: str, compress_level=6):
+    """Save a PNG, timing it as the image save stage of --stats"""
+    lap = tgrlib.stage_timer()
+    image.save(path, compress_level=compress_level)
+    lap('image save')
+
+def save_frame(imagefile: tgrlib.tgrFile, frame_index: int, output_dirs: dict, no_align_frames=False, fx_error_fix=False, compress_level=6):
+    """Decode a frame and save it once for each player color in output_dirs"""
+    for (image, path) in frame_images(imagefile, frame_index, output_dirs, no_align_frames, fx_error_fix):
+        save_image(image, path, compress_level)
+
+def save_frames_pipelined(imagefile: tgrlib.tgrFile, frame_indices: list, output_dirs: dict, args: argparse.Namespace):
+    """Decode frames in this thread while a pool of threads compresses
+    and writes the PNGs. At most two frames per save thread are held
+    in memory waiting to be saved"""
+    progress = FrameProgress(imagefile, len(frame_indices))
+    with futures.ThreadPoolExecutor(args.save_threads) as savers:
+        pending = deque()
+        for frame_index in frame_indices:
+            progress.started(frame_index, f'{frame_index} {imagefile.frames[frame_index].size}')
+            for (image, path) in frame_images(imagefile, frame_index, output_dirs, args.no_align_frames, args.fx_error_fix):
+                pending.append(savers.submit(save_image, image, path, args.compress_level))
+                while len(pending) > 2 * args.save_threads:
+                    pending.popleft().result()
+            # finished once decoded, as the saves are left to the threads
+            progress.finished(frame_index, frame_data_size(imagefile, frame_index))
+        for future in pending:
+            future.result()
+
+def save_atlas(imagefile: tgrlib.tgrFile, frame_indices: list, output_dirs: dict, args: argparse.Namespace):
+    """Decode frames into atlas pages instead of one PNG per frame,
+    writing the pages and an atlas.json sidecar for each player color"""
+    sizes = [imagefile.frames[i].size if i in frame_indices else (0, 0) for i in range(len(imagefile.frames))]
+    (placements, page_sizes) = tgrlib.layout_atlas(sizes, args.atlas_size)
+    pages = {color: [np.zeros((h, w, 4), dtype=np.uint8) for (w, h) in page_sizes] for color in output_dirs}
+    progress = FrameProgress(imagefile, len(frame_indices))
+    for frame_index in frame_indices:
+        progress.started(frame_index, f'{frame_index} {imagefile.frames[frame_index].size}')
+        (page, x, y) = placements[frame_index]
+        (w, h) = sizes[frame_index]
+        layers = imagefile.get_frame_layers(frame_index, fx_error_fix=args.fx_error_fix)
+        for color in output_dirs:
+            pages[color][page][y:y+h, x:x+w] = layers.with_color(tgrlib.player_color_lut(color))
+        progress.finished(frame_index, frame_data_size(imagefile, frame_index))
+    page_names = [f'atlas_{i:02d}.png' for i in range(len(page_sizes))]
+    for color, output_dir in output_dirs.items():
+        for name, page in zip(page_names, pages[color]):
+            save_image(Image.fromarray(page), f'{output_dir}/{name}', args.compress_level)
+        imagefile.write_atlas(f'{output_dir}/{tgrlib.atlas_name}', placements, page_names, color)
+
+def save_arrays(imagefile: tgrlib.tgrFile, frame_indices: list, output_dirs: dict, args: argparse.Namespace):
+    """Decode frames into one array of RGBA pixels per player color,
+    saved with a header describing the frames. Read them back with
+    tgrlib.load_frame_arrays"""
+    sizes = [imagefile.frames[i].size if i in frame_indices else (0, 0) for i in range(len(imagefile.frames))]
+    header = imagefile.frame_array_header(sizes)
+    pixel_offsets = header['pixel_offsets']
+    shape = (int(pixel_offsets[-1]), 4)
+    pixels = {}
+    for color, output_dir in output_dirs.items():
+        # npy pixels are written straight to a file that can be memory mapped
+        if args.format == 'npy':
+            pixels[color] = np.lib.format.open_memmap(f'{output_dir}/frames.npy', mode='w+', dtype=np.uint8, shape=shape)
+        else:
+            pixels[color] = np.zeros(shape, dtype=np.uint8)
+    progress = FrameProgress(imagefile, len(frame_indices))
+    for frame_index in frame_indices:
+        progress.started(frame_index, f'{frame_index} {imagefile.frames[frame_index].size}')
+        (start, end) = pixel_offsets[frame_index:frame_index+2]
+        layers = imagefile.get_frame_layers(frame_index, fx_error_fix=args.fx_error_fix)
+        for color in output_dirs:
+            pixels[color][start:end] = layers.with_color(tgrlib.player_color_lut(color)).reshape(-1, 4)
+        progress.finished(frame_index, frame_data_size(imagefile, frame_index))
+    lap = tgrlib.stage_timer()
+    for color, output_dir in output_dirs.items():
+        if args.format == 'npy':
+            pixels[color].flush()
+            np.savez(f'{output_dir}/frames.npz', color=color, **header)
+        else:
+            np.savez(f'{output_dir}/frames.npz', pixels=pixels[color], color=color, **header)
+    lap('image save')
+    pixels.clear()
+
+# Each unpack worker process maps and parses its own copy of the source file
+worker_file = None
+
+def init_unpack_worker(image_path: str):
+    global worker_file
+    worker_file = tgrlib.tgrFile(image_path, False, mapped=True, cache_bytes=0, on_event=tgrlib.ignore_event)
+    worker_file.load()
+
+def unpack_worker(frame_index: int, output_dirs: dict, no_align_frames=False, fx_error_fix=False, compress_level=6):
+    save_frame(worker_file, frame_index, output_dirs, no_align_frames, fx_error_fix, compress_level)
+    return frame_index
+
+def check_unpack_args(parser: argparse.ArgumentParser, args: argparse.Namespace, frame_jobs=True):
+    """Reject options the output format would ignore. frame_jobs is set
+    where --jobs decodes the frames of one file in parallel"""
+    if args.format != 'png':
+        if args.atlas:
+            parser.error(f'--atlas writes PNG pages, so it can\'t be used with --format {args.format}')
+        output = f'--format {args.format}'
+    elif args.atlas:
+        output = '--atlas'
+    else:
+        return
+    if args.no_align_frames:
+        parser.error(f'--no-align-frames can\'t be used with {output}, which keeps each frame at its own size')
+    if frame_jobs and args.jobs > 1:
+        parser.error(f'--jobs can\'t be used with {output}, which decodes the frames in one process')
 
 def unpack(args: argparse.Namespace):
+    """Unpack a .TGR file to PNGs, returning the number of frames decoded"""
+    check_unpack_args(unpack_parse, args)
     image_path = args.source
-    print(image_path)
-    print(Path(image_path))
     player_color = args.color
-    imagefile = tgrlib.tgrFile(image_path, False)
-    imagefile.load()
+    report('info', image_path)
+    report('info', str(Path(image_path)))
+    imagefile = open_tgr(image_path)
 
     if args.output != None:
         image_name = args.output
     else:
         image_name = Path(image_path).stem
-    print(args.output)
-    print(image_name)
-    Path(image_name).mkdir(exist_ok=True, parents=True)
+    imagefile.emit('info', str(args.output))
+    imagefile.emit('info', image_name)
+
+    # With --all-colors each player color gets its own directory,
+    # but every frame is only decoded once
+    if args.all_colors:
+        output_dirs = {color: f"{image_name}/color_{color:02d}" for color in sorted(tgrlib.get_player_colors())}
+    else:
+        output_dirs = {player_color: image_name}
+    for output_dir in output_dirs.values():
+        Path(output_dir).mkdir(exist_ok=True, parents=True)
 
     frame_index = 0
-    pixel_format = "RGBA"
+    decode_frames = []
+    # found again each time, as the file may be from the session cache
+    imagefile.padding_frames = []
     for frame_index, frame in enumerate(imagefile.frames):
         
         # Check for padding (blank) frames
         if frame.size == (0, 0,):
-            print(f'padding frame {frame_index}')
+            imagefile.emit('info', f'padding frame {frame_index}', frame_index=frame_index)
             imagefile.padding_frames.append(frame_index)
+            # the atlas and array formats list padding frames in their headers instead
+            if args.atlas or args.format != 'png':
+                continue
             image = Image.new('RGBA',(1,1),(0,0,0,0))
-            image.save(f"{image_name}/fram_{frame_index:04d}.png")
+            for output_dir in output_dirs.values():
+                image.save(f"{output_dir}/fram_{frame_index:04d}.png", compress_level=args.compress_level)
             continue            
         
         if args.single_frame != -1 and args.single_frame != frame_index:
@@ -39,49 +240,193 @@ def unpack(args: argparse.Namespace):
     #print(imagefile.framecount)
     # frame = imagefile.frames[frame_index]
 
-        print(frame_index, frame.size)
-        imagedata = b""
-        with open(image_path, "rb") as in_fh:
-            for idx in range(len(frame.lines)):
-                rawline = imagefile.extractLine(in_fh, frame_index=frame_index, line_index=idx, increment=0, color=player_color, fx_error_fix=args.fx_error_fix)
-                #print(f"{idx+1:3d}: 0x{frame.lines[idx].offset:06x}, {len(rawline)}")
-                if len(rawline) < frame.size[0]:
-                    rawline += [tgrlib.transparency for _ in range(frame.size[0] - len(rawline))]
-                #while len(rawline) < frame.size[0]:
-                #    rawline.append(tgrlib.Pixel(0, 0, 0))
-                if len(rawline) > frame.size[0]:
-                    rawline = rawline[0:frame.size[0]]
-                imagedata += b"".join([elem.pack_to_bin(pixel_format) for elem in rawline])
-                #print(len(imagedata))
-        target_len = (frame.size[0] * frame.size[1]) * (3 if format == "RGB" else 4)
-        if len(imagedata) < target_len:
-            imagedata += bytes([0x00 for _ in range(target_len - len(imagedata))])
-        if args.no_align_frames:
-            image = Image.new(pixel_format, frame.size)
-            image.frombytes(imagedata)
-        else:
-            image = Image.new(pixel_format, imagefile.size)
-            fram_img = Image.new(pixel_format, frame.size)
-            fram_img.frombytes(imagedata)
-            offset = imagefile.frameoffsets[frame_index][0]
-            image.paste(fram_img, offset)
-        image.save(f"{image_name}/fram_{frame_index:04d}.png")
+        decode_frames.append(frame_index)
+
+    if args.format != 'png':
+        save_arrays(imagefile, decode_frames, output_dirs, args)
+    elif args.atlas:
+        save_atlas(imagefile, decode_frames, output_dirs, args)
+    elif args.jobs > 1:
+        worker = partial(unpack_worker, output_dirs=output_dirs, no_align_frames=args.no_align_frames, fx_error_fix=args.fx_error_fix, compress_level=args.compress_level)
+        # frames are decoded in the workers, so only their finishing is reported
+        progress = FrameProgress(imagefile, len(decode_frames))
+        with futures.ProcessPoolExecutor(args.jobs, initializer=init_unpack_worker, initargs=(image_path,)) as pool:
+            for frame_index in pool.map(worker, decode_frames):
+                progress.finished(frame_index, frame_data_size(imagefile, frame_index), f'{frame_index} {imagefile.frames[frame_index].size}')
+    elif args.save_threads > 0:
+        save_frames_pipelined(imagefile, decode_frames, output_dirs, args)
+    else:
+        progress = FrameProgress(imagefile, len(decode_frames))
+        for frame_index in decode_frames:
+            progress.started(frame_index, f'{frame_index} {imagefile.frames[frame_index].size}')
+            save_frame(imagefile, frame_index, output_dirs, args.no_align_frames, args.fx_error_fix, args.compress_level)
+            progress.finished(frame_index, frame_data_size(imagefile, frame_index))
+    imagefile.close()
     if args.config:
-        config_path = args.config
+        imagefile.write_config(args.config)
     else:
-        config_path = f"{image_name}/sprite.ini"
-    imagefile.write_config(config_path)
+        for output_dir in output_dirs.values():
+            imagefile.write_config(f"{output_dir}/sprite.ini")
+    return len(decode_frames)
+
+def unpack_tree_worker(image_path: str, image_name: str, args: argparse.Namespace):
+    """Unpack one file of a tree, returning its path, frame count,
+    time taken and error message. Errors are returned rather than
+    raised so one bad file doesn't stop the batch"""
+    file_args = argparse.Namespace(**vars(args))
+    file_args.source = image_path
+    file_args.output = image_name
+    file_args.config = None
+    file_args.single_frame = -1
+    file_args.jobs = 1
+    file_args.save_threads = 0
+    # Each worker process unpacks one file at a time, silently
+    global events
+    events = tgrlib.ignore_event
+    start = time.perf_counter()
+    frames = 0
+    error = None
+    try:
+        frames = unpack(file_args)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return (image_path, frames, time.perf_counter() - start, error)
+
+def unpack_tree(args: argparse.Namespace):
+    check_unpack_args(unpack_tree_parse, args, frame_jobs=False)
+    source = Path(args.source)
+    dest = Path(args.dest)
+    files = [p for p in source.rglob('*') if p.is_file() and p.suffix.upper() == '.TGR']
+    file_sizes = {str(p): p.stat().st_size for p in files}
+    # Start the largest files first so a big file isn't left running on its own at the end
+    files.sort(key=lambda p: file_sizes[str(p)], reverse=True)
+    report('info', f'Unpacking {len(files)} files from {source} to {dest} using {args.jobs} processes')
+
+    results = []
+    failed = []
+    done_bytes = 0
+    start = time.perf_counter()
+    with futures.ProcessPoolExecutor(args.jobs) as pool:
+        pending = {pool.submit(unpack_tree_worker, str(p), str(dest / p.relative_to(source).parent / p.stem), args): str(p) for p in files}
+        for future in futures.as_completed(pending):
+            try:
+                (image_path, frames, seconds, error) = future.result()
+            except Exception as e:
+                (image_path, frames, seconds, error) = (pending[future], 0, 0.0, f'{type(e).__name__}: {e}')
+            if error:
+                failed.append((image_path, error))
+                report('warning', f'[{len(results) + len(failed)}/{len(files)}] failed {image_path}: {error}')
+            else:
+                results.append((image_path, frames, seconds))
+                report('info', f'[{len(results) + len(failed)}/{len(files)}] {image_path}: {frames} frames in {seconds:.2f}s')
+            done_bytes += file_sizes[image_path]
+            report('progress', f'{len(results) + len(failed)}/{len(files)} files, {done_bytes} bytes',
+                   done=len(results) + len(failed), total=len(files), nbytes=done_bytes)
+    elapsed = time.perf_counter() - start
+
+    total_frames = sum(r[1] for r in results)
+    total_mb = sum(file_sizes[r[0]] for r in results) / (1024 * 1024)
+    report('info', f'\nUnpacked {len(results)} files ({len(failed)} failed) in {elapsed:.2f}s')
+    if elapsed > 0:
+        report('info', f'{len(results) / elapsed:.1f} files/s, {total_frames / elapsed:.1f} frames/s, {total_mb / elapsed:.2f} MB/s')
+    if results and args.slowest > 0:
+        report('info', 'Slowest files:')
+        for (image_path, frames, seconds) in sorted(results, key=lambda r: r[2], reverse=True)[:args.slowest]:
+            report('info', f'  {seconds:7.2f}s {frames:5d} frames {image_path}')
+    if failed:
+        report('warning', 'Failed files:')
+        for (image_path, error) in failed:
+            report('warning', f'  {image_path}: {error}')
+
+def pack_frames(imagefile: tgrlib.tgrFile, color: int, args: argparse.Namespace, cache: tgrlib.EncodeCache|None=None):
+    """Stream the frames of a lazily loaded source, yielding the index and
+    FRAM chunk of each frame in order, with None for padding frames.
+    Frames found in the cache aren't encoded again. With --jobs, frames
+    are encoded in a process pool with at most two per process queued
+    ahead of the one being written, so only a few frames are in memory.
+    With --optimize the greedy size of each encoded frame is yielded too,
+    otherwise it is None"""
+    encoder = optimize_frame if args.optimize else tgrlib.encode_frame
+    with contextlib.ExitStack() as stack:
+        pool = stack.enter_context(futures.ProcessPoolExecutor(args.jobs)) if args.jobs > 1 else None
+        # Each entry is the frame index, a cache key if the chunk needs caching, and the chunk or its future
+        pending = deque()
+        for (frame_index, pixels) in imagefile.stream_frames():
+            key = None
+            frame_chunk = None
+            imagefile.emit('frame_started', frame_index=frame_index)
+            if pixels is not None:
+                framesize = imagefile.framesizes[frame_index]
+                if cache:
+                    key = cache.key(pixels, framesize, color, args.no_crop, args.optimize, imagefile.pack_palette)
+                    frame_chunk = cache.get(key, framesize)
+                if frame_chunk is not None:
+                    key = None
+                elif pool:
+                    frame_chunk = pool.submit(encoder, pixels, color, frame_index, palette=imagefile.pack_palette)
+                else:
+                    frame_chunk = encoder(pixels, color, frame_index, palette=imagefile.pack_palette)
+            pending.append((frame_index, key, frame_chunk))
+            while len(pending) > (2 * args.jobs if pool else 0):
+                yield finish_frame(imagefile, cache, *pending.popleft())
+        while pending:
+            yield finish_frame(imagefile, cache, *pending.popleft())
+
+def optimize_frame(pixels: np.ndarray, color: int, frame_index: int, palette: tgrlib.Palette|None=None):
+    """Encode a frame with the size-optimal encoder, returning the FRAM
+    chunk and the size the greedy encoder would have made it"""
+    frame_chunk = tgrlib.encode_frame(pixels, color, frame_index, optimize=True, palette=palette)
+    return (frame_chunk, len(tgrlib.encode_frame(pixels, color, frame_index, palette=palette)))
+
+def source_histogram(source: str, color: int):
+    """Count the palette colours of a .TGR file, or of the frames of a
+    directory, PNG or atlas that could be packed"""
+    imagefile = tgrlib.tgrFile(source, on_event=tgrlib.ignore_event)
+    if imagefile.read_from != '.TGR':
+        imagefile.load(f'{source}/sprite.ini', lazy=True)
+        return imagefile.color_histogram(color)
+    imagefile.load()
+    histogram = np.zeros(0x10000, dtype=np.int64)
+    for frame_index in range(len(imagefile.frames)):
+        if imagefile.framesizes[frame_index][2] != 0:
+            histogram += tgrlib.color_histogram(imagefile.decodeFrame(frame_index, color), color)
+    imagefile.close()
+    return histogram
+
+def finish_frame(imagefile: tgrlib.tgrFile, cache, frame_index: int, key, frame_chunk):
+    if isinstance(frame_chunk, futures.Future):
+        frame_chunk = frame_chunk.result()
+    greedy_size = None
+    if isinstance(frame_chunk, tuple):
+        (frame_chunk, greedy_size) = frame_chunk
+    if key is not None:
+        cache.put(key, imagefile.framesizes[frame_index], frame_chunk)
+    return (frame_index, frame_chunk, greedy_size)
 
 def pack(args: argparse.Namespace):
-    imagefile = tgrlib.tgrFile(args.source)
-    print(imagefile.imgs[0].mode)
+    imagefile = tgrlib.tgrFile(args.source, on_event=events)
     config_path = args.config if args.config else f"{args.source}/sprite.ini"
+    color = args.color
+    # Default to the player color an atlas was unpacked with
+    if color is None and imagefile.atlas is not None:
+        color = imagefile.atlas['color']
     
     if args.portrait != None:
         imagefile.resize(args.portrait)
         imagefile.addPortraitFrame(args.portrait)
     
-    imagefile.load(config_path, args.no_crop)
+    imagefile.load(config_path, args.no_crop, lazy=True)
+    if args.depth is not None:
+        imagefile.bits_per_px = args.depth
+    if imagefile.bits_per_px == 8:
+        lap = tgrlib.stage_timer()
+        if args.palette_from:
+            histogram = sum(source_histogram(source, color) for source in args.palette_from)
+        else:
+            histogram = imagefile.color_histogram(color)
+        imagefile.pack_palette = tgrlib.median_cut_palette(histogram)
+        lap('palette')
+        imagefile.emit('info', f'8 bit palette of {len(imagefile.pack_palette)} colors, from {np.count_nonzero(histogram)} colors used')
     
     if args.output != '' and args.output != None:
         dest_path = Path(args.output)
@@ -96,19 +441,124 @@ def pack(args: argparse.Namespace):
     else:
         outfile = imagefile.filename.stem + '.tgr'
     
-    data = b''
-    for frame_index in range(0,len(imagefile.img_data)):
-        if frame_index in imagefile.padding_frames:
-            imagefile.frameoffsets.append(0)
-            data += struct.pack('4sI', b'FRAM', 0)
+    imagefile.emit('info', f'writing to:  {outfile}')
+    cache = None if args.no_cache else tgrlib.EncodeCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    # Sizes of the frames encoded with --optimize, and their greedy sizes
+    optimized_size = 0
+    greedy_size = 0
+    progress = FrameProgress(imagefile, len(imagefile.imgs))
+    # Written next to the output and moved over it once complete, so a
+    # frame failing to pack doesn't leave a broken file at outfile
+    temp_path = Path(outfile).with_name(f'{Path(outfile).name}.{os.getpid()}.tmp')
+    try:
+        with open(temp_path, 'wb') as fh_out, tgrlib.TgrWriter(fh_out, imagefile) as writer:
+            for (frame_index, frame_chunk, frame_greedy_size) in pack_frames(imagefile, color, args, cache):
+                if frame_chunk is None:
+                    writer.write_padding_frame()
+                    progress.finished(frame_index, 0)
+                else:
+                    writer.write_frame(frame_chunk)
+                    progress.finished(frame_index, len(frame_chunk))
+                    # Counted here so frames encoded by --jobs or taken from the cache are included
+                    if tgrlib.stats is not None:
+                        tgrlib.stats.add_frame_data(frame_chunk[8:], imagefile.framesizes[frame_index][1], imagefile.bits_per_px)
+                if frame_greedy_size is not None:
+                    optimized_size += len(frame_chunk)
+                    greedy_size += frame_greedy_size
+        os.replace(temp_path, outfile)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    if greedy_size:
+        saved = greedy_size - optimized_size
+        imagefile.emit('info', f'optimized frames: {optimized_size} bytes, {saved} bytes ({saved / greedy_size:.1%}) smaller than greedy encoding')
+    if cache:
+        imagefile.emit('info', f'{cache.hits} frames taken from {cache.directory}, {cache.misses} encoded')
+        cache.evict()
+
+def info(args: argparse.Namespace):
+    """Print the header of a .TGR file. Nothing but the header is read,
+    so numpy and PIL aren't imported"""
+    # Only pass on warnings, as the header is reported here
+    imagefile = open_tgr(args.source, lambda event: events(event) if event.kind == 'warning' else None)
+    imagefile.close()
+    frames = []
+    for ((width, height, offset), (upper_left, lower_right)) in zip(imagefile.framesizes, imagefile.frameoffsets):
+        frames.append({'size': [width, height], 'upper_left': list(upper_left), 'lower_right': list(lower_right)} if offset else None)
+    header = {'file': str(imagefile.filename),
+              'version': imagefile.version,
+              'bits_per_px': imagefile.bits_per_px,
+              'size': list(imagefile.size),
+              'hotspot': list(imagefile.hotspot),
+              'bounding_box': imagefile.bounding_box,
+              'palette_colors': len(imagefile.palette_words) if imagefile.indexed_colour else None,
+              'frames': frames,
+              'animations': [{'start_frame': start, 'frame_count': count, 'animation_count': animations}
+                             for (start, count, animations) in imagefile.animations]}
+    if args.json:
+        report('info', json.dumps(header, indent=1))
+        return
+    (width, height) = imagefile.size
+    report('info', f'{header["file"]}: version {header["version"]}, {width}x{height}, {imagefile.bits_per_px} bits per pixel')
+    if imagefile.indexed_colour:
+        report('info', f'{header["palette_colors"]} palette colors')
+    report('info', f'hotspot {header["hotspot"]}, bounding box {header["bounding_box"]}')
+    report('info', f'{len(frames)} frames, {frames.count(None)} padding, {len(header["animations"])} animations')
+    for (index, animation) in enumerate(header['animations']):
+        report('info', f'  animation {index}: {animation["frame_count"]} frames from {animation["start_frame"]}, count {animation["animation_count"]}')
+    if args.frames:
+        for (index, frame) in enumerate(frames):
+            if frame is None:
+                report('info', f'  frame {index}: padding')
+            else:
+                report('info', f'  frame {index}: {frame["size"][0]}x{frame["size"][1]} at {frame["upper_left"]}')
+
+def cache(args: argparse.Namespace):
+    """Show or clear the files and frames held by the interactive tool"""
+    if session is None:
+        report('warning', 'Files are only kept between the commands of the interactive tool')
+        return
+    if args.clear:
+        session.clear()
+        report('info', 'Cleared the session cache')
+        return
+    stats = session.stats()
+    report('info', f'{len(session)} files, {stats["bytes"] / 2**20:.1f} of {stats["max_bytes"] / 2**20:.0f} MB of frames, {stats["hits"]} hits, {stats["misses"]} misses')
+    for (path, frames) in stats['files'].items():
+        report('info', f'  {path}: {frames["frames"]} frames, {frames["bytes"] / 2**20:.1f} MB, {frames["hits"]} hits, {frames["misses"]} misses')
+
+def run(args: argparse.Namespace, on_event=None):
+    """Run a parsed command, passing its messages, warnings, frame events
+    and progress to on_event as tgrlib Events. If on_event isn't given
+    they are printed, or dropped with --quiet, and --progress prints the
+    progress too. With --stats the runs read or written and the time
+    taken by each stage are reported and saved as JSON afterwards"""
+    global events
+    if on_event is None:
+        if args.quiet:
+            on_event = tgrlib.ignore_event
+        elif args.progress or args.progress_interval is not None:
+            interval = 1.0 if args.progress_interval is None else args.progress_interval
+            on_event = tgrlib.RateLimited(partial(tgrlib.print_event, progress=True), interval)
         else:
-            imagefile.frameoffsets.append(len(data))
-            data += imagefile.encodeFrame(frame_index, color=args.color)
-    data = imagefile.encodeHeader(data)
-    data = imagefile.encodeForm(data)
-    print("writing to: ", outfile)
-    with open(outfile ,'wb') as fh_out:
-        fh_out.write(data)
+            on_event = tgrlib.print_event
+    events = on_event
+    stats_file = args.stats_file
+    if args.stats and stats_file is None:
+        stats_file = 'tgrtool_stats.json'
+    if stats_file is not None:
+        tgrlib.stats = tgrlib.CodecStats()
+    try:
+        lap = tgrlib.stage_timer()
+        args.func(args)
+        if stats_file is not None:
+            lap('total')
+            report('info', tgrlib.stats.report())
+            Path(stats_file).write_text(json.dumps(tgrlib.stats.as_dict(), indent=2))
+            report('info', f'stats written to {stats_file}')
+    finally:
+        tgrlib.stats = None
+        events = tgrlib.print_event
 
 # from https://stackoverflow.com/a/34256516
 # Allows filepaths with spaces to be parsed correctly
@@ -119,12 +569,24 @@ class MyAction(argparse.Action):
 
 ## Define parsers
 main_parse = argparse.ArgumentParser(prog="tgrtool")
+main_parse.add_argument('-q', '--quiet', action='store_true', help='print no messages, warnings or progress. Errors are still raised')
+main_parse.add_argument('--progress', action='store_true', help='print the frames and bytes done so far, at most once a second or every --progress-interval')
+main_parse.add_argument('--progress-interval', default=None, type=float, metavar='SECONDS', help='print the --progress at most once every SECONDS. Implies --progress')
+main_parse.add_argument('--stats', action='store_true', help='count the runs decoded or encoded for each run flag, their lengths and the line header sizes, and time each stage. The stats are printed and written to tgrtool_stats.json, or the --stats-file. Runs decoded and stages run in --jobs or unpack-tree worker processes are not included, except for the frames pack writes')
+main_parse.add_argument('--stats-file', default=None, metavar='JSON', help='write the --stats to this file instead of tgrtool_stats.json. Implies --stats')
 
 sub_parsers = main_parse.add_subparsers(required=True, help="available commands")
 
 unpack_parse = sub_parsers.add_parser("unpack")
 unpack_parse.set_defaults(func=unpack)
 unpack_parse.add_argument('-c', '--color', choices=range(1,12), default=2, type=int, help='use the specified player color for extracted sprites. Defaults to 2 (blue)')
+unpack_parse.add_argument('--all-colors', action='store_true', help='extract the sprite in every player color, each to its own color_NN subdirectory. Frames are only decoded once')
+unpack_parse.add_argument('-j', '--jobs', default=1, type=int, help='number of processes used to decode and save frames. Defaults to 1')
+unpack_parse.add_argument('--save-threads', default=2, type=int, help='number of threads compressing and saving PNGs while frames are decoded, when not using --jobs. 0 saves each frame before decoding the next. Defaults to 2')
+unpack_parse.add_argument('--compress-level', choices=range(0,10), default=6, type=int, help='PNG compression level, from 0 (fastest, largest files) to 9 (slowest, smallest files). Defaults to 6')
+unpack_parse.add_argument('--atlas', action='store_true', help='pack the frames into atlas_NN.png sprite sheets with an atlas.json sidecar instead of writing one PNG per frame. pack accepts the output directory as-is')
+unpack_parse.add_argument('--atlas-size', default=2048, type=int, help='maximum width and height of each atlas page. Frames larger than this get a page of their own size. Defaults to 2048')
+unpack_parse.add_argument('--format', choices=('png','npz','npy'), default='png', help='output format. npz saves every frame and a header with the frame sizes, offsets, hotspot, bounding box and animations to frames.npz. npy saves the pixels to frames.npy instead, so they can be loaded with mmap_mode. Defaults to png')
 unpack_parse.add_argument('-v', '--verbose', action='store_true', help='enable debugging printouts')
 unpack_parse.add_argument('--no-align-frames', action='store_true', help='disable frame alignment within image size')
 unpack_parse.add_argument('--single-frame', default=-1, type=int, help='extract only the specified frame')
@@ -133,18 +595,55 @@ unpack_parse.add_argument('-o', '--output', type=str, default=None, help='destin
 unpack_parse.add_argument('--config', type=str, help="path to write sprite config file")
 unpack_parse.add_argument('source', type=str, help='path to target tgr file', nargs='+', action=MyAction)
 
+unpack_tree_parse = sub_parsers.add_parser("unpack-tree")
+unpack_tree_parse.set_defaults(func=unpack_tree)
+unpack_tree_parse.add_argument('-c', '--color', choices=range(1,12), default=2, type=int, help='use the specified player color for extracted sprites. Defaults to 2 (blue)')
+unpack_tree_parse.add_argument('--all-colors', action='store_true', help='extract every sprite in every player color, each to its own color_NN subdirectory')
+unpack_tree_parse.add_argument('-j', '--jobs', default=os.cpu_count(), type=int, help='number of files unpacked at once. Defaults to the number of CPUs')
+unpack_tree_parse.add_argument('--no-align-frames', action='store_true', help='disable frame alignment within image size')
+unpack_tree_parse.add_argument('--compress-level', choices=range(0,10), default=6, type=int, help='PNG compression level, from 0 (fastest, largest files) to 9 (slowest, smallest files). Defaults to 6')
+unpack_tree_parse.add_argument('--atlas', action='store_true', help='write each sprite as atlas_NN.png sprite sheets with an atlas.json sidecar instead of one PNG per frame')
+unpack_tree_parse.add_argument('--atlas-size', default=2048, type=int, help='maximum width and height of each atlas page. Defaults to 2048')
+unpack_tree_parse.add_argument('--format', choices=('png','npz','npy'), default='png', help='output format, as for unpack. Defaults to png')
+unpack_tree_parse.add_argument('--fx-error-fix', action='store_true', help='use this if non-unit .TGR files have multicolored horizontal stripes in the output')
+unpack_tree_parse.add_argument('--slowest', default=10, type=int, help='number of slowest files to list at the end. Defaults to 10')
+unpack_tree_parse.add_argument('source', type=str, help='directory to search for .tgr files')
+unpack_tree_parse.add_argument('dest', type=str, help='directory to unpack into, mirroring the layout of the source directory')
+
+info_parse = sub_parsers.add_parser("info")
+info_parse.set_defaults(func=info)
+info_parse.add_argument('--frames', action='store_true', help='list the size and position of every frame')
+info_parse.add_argument('--json', action='store_true', help='print the header as JSON')
+info_parse.add_argument('source', type=str, help='path to target tgr file', nargs='+', action=MyAction)
+
+cache_parse = sub_parsers.add_parser("cache")
+cache_parse.set_defaults(func=cache)
+cache_parse.add_argument('--clear', action='store_true', help='drop every file and decoded frame kept between commands of the interactive tool')
+
 pack_parse = sub_parsers.add_parser("pack")
 pack_parse.set_defaults(func=pack)
 pack_parse.add_argument('-c', '--color', choices=range(1,12), default=None, type=int, help='Specify the color list used for player-colored pixels. Pixels matching the list will be converted to player pixels')
+pack_parse.add_argument('-j', '--jobs', default=1, type=int, help='number of processes used to encode frames. The output is the same for any number. Defaults to 1')
 pack_parse.add_argument('-o', '--output', type=str, help='destination file for packed data')
+pack_parse.add_argument('--depth', choices=(8,16), default=None, type=int, help='bits per pixel. 8 quantises the frames to a palette of up to 256 colors, roughly halving the size of the frame data. Defaults to the Depth in the sprite config')
+pack_parse.add_argument('--palette-from', action='append', default=[], help='with --depth 8, build the palette from the colors of this .tgr file or source directory instead of the source being packed. Can be given more than once, and files packed with the same list share a palette')
+pack_parse.add_argument('--optimize', action='store_true', help='encode each line in the fewest bytes possible instead of with the faster greedy encoder, and report the size saved. Frames taken from the cache are not counted')
+pack_parse.add_argument('--no-cache', action='store_true', help='encode every frame, without reading or writing the frame cache')
+pack_parse.add_argument('--cache-dir', type=str, default=None, help='directory for the cache of encoded frames. Defaults to tgrtool/frames in the user cache directory')
+pack_parse.add_argument('--cache-size', default=512, type=int, help='size in MB the frame cache is trimmed to after packing, removing the least recently used frames. Defaults to 512')
 pack_parse.add_argument('--config', type=str, help='path to sprite config file')
 pack_parse.add_argument('--no-crop', action='store_true', help='Disable automatic cropping of transparent background pixels')
 pack_parse.add_argument('--portrait', choices=('large','small'), default=None, type=str, help='Specify the size of the portrait. Choose small for company/sidebar portraits, or large for campaign dialogue portraits')
 pack_parse.add_argument('source', type=str, help='path to file or directory to unpack', nargs='+', action=MyAction)
 
 if __name__ == '__main__':
+    # needed for worker processes in the PyInstaller exe
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
     if tgrlib.is_exe:
         print('Welcome to TGR Tool. Please enter a command, or type "--help" for help, or "exit" to exit')
+        session = tgrlib.SessionCache()
         
         while True:
             command = input('tgrtool > ')
@@ -154,9 +653,10 @@ if __name__ == '__main__':
                 break
             try:              
                 args = main_parse.parse_args(command.split(' '))
-                args.func(args)
+                run(args)
+                session.trim()
             except SystemExit:
                 print('')
     else:
         args = main_parse.parse_args()
-        args.func(args)
+        run(args)
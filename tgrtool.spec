@@ -10,7 +10,11 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('.\\data', 'data')],
-    hiddenimports=[],
+    # tgrlib and tgrtool import these through lazy_import, which the
+    # analysis can't follow
+    hiddenimports=['numpy', 'PIL.Image', 'PIL.PngImagePlugin', 'configparser',
+                   'concurrent.futures', 'concurrent.futures.thread',
+                   'concurrent.futures.process', 'hashlib', 'typing'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],